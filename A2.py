@@ -3,8 +3,7 @@ from A1 import create_patients
 import os
 import pandas as pd
 import shutil
-from data_helpers import image_cropper, resample_all_images, write_cropped_images_train_and_folds
-import pickle as pk
+from data_helpers import image_cropper, resample_all_images, write_cropped_images_train_and_folds, save_folds
 
 
 def write_cropped_images_test(cropped_images):
@@ -122,14 +121,9 @@ if __name__ == "__main__":
     cropped_images_train = image_cropper(findings_train, resampled_images, padding_filter, *desired_patch_dimensions,
                                          num_crops_per_image=num_crops, train=True)
 
-    fold_key_mappings, train_key_mappings = write_cropped_images_train_and_folds(cropped_images_train,
-                                                                                 num_crops=num_crops)
+    fold_indices, train_indices = write_cropped_images_train_and_folds(cropped_images_train, seed=0)
 
-    with open("/home/andrewg/PycharmProjects/assignments/fold_key_mappings2.pkl", 'wb') as output:
-        pk.dump(fold_key_mappings, output, pk.HIGHEST_PROTOCOL)
-
-    with open("/home/andrewg/PycharmProjects/assignments/train_key_mappings2.pkl", 'wb') as output:
-        pk.dump(train_key_mappings, output, pk.HIGHEST_PROTOCOL)
+    save_folds("/home/andrewg/PycharmProjects/assignments/folds2.npz", train_indices, fold_indices)
 
     # cropped_images_test = image_cropper(findings_test, resampled_images, padding_filter, *desired_patch_dimensions,
     #                                     num_crops_per_image=1, train=False)
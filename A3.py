@@ -1,12 +1,16 @@
 import os
+import numpy as np
 import SimpleITK as sitk
 import torch.nn as nn
 import torch.utils.data
 from torch.utils.data import DataLoader
 import pandas as pd
-import pickle as pk
-from data_helpers import ProstateImages, k_fold_cross_validation
+from data_helpers import ProstateImages, FoldSubset, ClassBalancedSampler, load_folds, k_fold_cross_validation
 from models import CNN, CNN2
+from engine import configure_threads
+from profiling import StepProfiler
+from ensemble import FoldEnsemble
+from run_registry import RunRegistry
 
 
 def read_cropped_images(modality):
@@ -39,29 +43,44 @@ def read_cropped_images(modality):
     return cropped_images
 
 
-def test_predictions(dataloader, model, softmax=False):
+def test_predictions(dataloader, model, softmax=False, profile_dir=None, profile_window=(1, 1, 5)):
     """
     This function runs the model on the batches in the test set and returns a dataframe with ProxID, fid, and ClinSig
-    columns. The predictions x <- ClinSig, 0 <= x <= 1, x <- R.
-    :param dataloader: The data loader with the test batches
+    columns. The predictions x <- ClinSig, 0 <= x <= 1, x <- R. The scores are written into a preallocated array and
+    joined with the findings once, at the end
+    :param dataloader: The data loader with the test batches, in the order of the findings (not shuffled). Large batches
+                       and worker processes reading the crops keep the model busy
     :param model: The trained pytorch model
+    :param softmax: Whether the model outputs the probabilities of both classes (CNN2), the cancer one is kept
+    :param profile_dir: If given, a window of batches is profiled with torch.profiler and the Chrome trace and top
+                        operator table are written to this directory (see profiling.StepProfiler)
+    :param profile_window: The (wait, warmup, active) batches of the profiling window
     :return: A dataframe as described above
     """
 
     model.eval()
+    device = next(model.parameters()).device
     test_file = r"/home/andrewg/PycharmProjects/assignments/ProstateX-TestLesionInformation/ProstateX-Findings-Test.csv"
     predictions = pd.read_csv(test_file)
-    predictions.insert(4, "ClinSig", 0)
-    predictions = predictions.drop(["pos", "zone"], axis=1)
+    scores = np.empty(len(dataloader.dataset), dtype=np.float32)
     end_batch = 0
-
-    for idx, batch in enumerate(dataloader):
-        outputs = model(batch["image"])
-        if softmax:
-            outputs = torch.tensor([tup[1] for tup in outputs])
-        start_batch = end_batch
-        end_batch = start_batch + len(outputs)
-        predictions["ClinSig"].iloc[start_batch: end_batch] = outputs.flatten().tolist()
+    profiler = StepProfiler(profile_dir, "test", device, window=profile_window, enabled=profile_dir is not None)
+
+    profiler.start()
+    with torch.inference_mode():
+        for batch in dataloader:
+            outputs = model(batch["image"].to(device, non_blocking=True))
+            outputs = outputs[:, 1] if softmax else outputs.view(-1)
+            start_batch = end_batch
+            end_batch = start_batch + len(outputs)
+            scores[start_batch: end_batch] = outputs.float().cpu().numpy()
+            profiler.step()
+    profiler.stop()
+
+    if end_batch != len(predictions):
+        raise ValueError("{} test crops were scored for {} findings".format(end_batch, len(predictions)))
+    predictions.insert(4, "ClinSig", scores)
+    predictions = predictions.drop(["pos", "zone"], axis=1)
     return predictions
 
 
@@ -74,76 +93,105 @@ if __name__ == "__main__":
     cuda_destination = 1
     batch_size_train = 100
     batch_size_val = 50
-    batch_size_test = 50
+    batch_size_test = 500
+    num_test_loader_workers = 4  # Processes reading the test crops while the model scores them
+    samples_per_epoch = None  # None means one pass worth of samples over the fold's training set
     k_low, k_high = 0, 5
     epochs = 20
+    patience = None  # Stop a fold after this many validations without a better AUC, None trains every epoch
+    val_every = 1
     lr = 0.00001
     final_lr = 0.01
+    num_threads = None  # CPU thread budget, None keeps torch's default
+    bf16 = False  # bfloat16 autocast, mainly useful on CPUs with AVX512-BF16/AMX
+    channels_last = False  # Channels-last 2D convolutions, compare the throughput of both with the registry
+    num_fold_workers = 1  # Folds trained concurrently (CPU only), each with num_threads or an even share of the cores
+    resume = False  # Continue an interrupted run from its per-fold checkpoints (only if it is configured the same)
+    record_timings = False  # Log per-phase timings of every epoch (see profiling.summarize_timings)
+    profile = False  # Profile a few training and test batches with torch.profiler
+    ensemble_folds = True  # Score the test set with the mean of every fold's model instead of the first fold's
     softmax = False
     if softmax:
-        loss_function = nn.CrossEntropyLoss().cuda(cuda_destination)
+        loss_function = nn.CrossEntropyLoss()
         model = CNN2
         model_type = "CNN2"
     else:
-        loss_function = nn.BCELoss().cuda(cuda_destination)
+        loss_function = nn.BCELoss()
         model = CNN
         model_type = "CNN"
 
     ngpu = 1
     device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
+    configure_threads(num_threads)
     modality = "adc"
+    # Delete this directory to start an interrupted run over
+    resume_dir = "/home/andrewg/PycharmProjects/assignments/predictions/checkpoints/{}/{}".format(modality, model_type)
+    timing_dir = "/home/andrewg/PycharmProjects/assignments/predictions/timings/{}/{}".format(modality, model_type)
+    profile_dir = "/home/andrewg/PycharmProjects/assignments/predictions/profiles/{}/{}".format(modality, model_type)
     image_folder_contents = os.listdir("/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/{}".format(
                                                                                                             modality))
 
-    with open("/home/andrewg/PycharmProjects/assignments/train_key_mappings2.pkl", "rb") as f:
-        train_key_mappings = pk.load(f)
-    with open("/home/andrewg/PycharmProjects/assignments/fold_key_mappings2.pkl", "rb") as f:
-        fold_key_mappings = pk.load(f)
+    folds_file = "/home/andrewg/PycharmProjects/assignments/folds2.npz"
+    train_indices, fold_indices = load_folds(folds_file)
 
-    p_images_train = ProstateImages(modality=modality, train=True, device=device, normalize_strategy=1,
-                                    mapping=train_key_mappings)
+    p_images = ProstateImages(modality=modality, train=True, device=device, normalize_strategy=1)
+    p_images_train = FoldSubset(p_images, train_indices)
+    p_images_validation = FoldSubset(p_images, fold_indices)
 
-    p_images_validation = ProstateImages(modality=modality, train=True, device=device, normalize_strategy=1,
-                                         mapping=fold_key_mappings)
-
-    dataloader_train = DataLoader(p_images_train, batch_size=batch_size_train, shuffle=True)
+    sampler_train = ClassBalancedSampler(p_images_train, num_samples=samples_per_epoch)
+    dataloader_train = DataLoader(p_images_train, batch_size=batch_size_train, sampler=sampler_train)
     dataloader_val = DataLoader(p_images_validation, batch_size=batch_size_val)
 
+    # Query and compare runs with: python run_registry.py list / show RUN_ID / compare RUN_ID RUN_ID
+    registry = RunRegistry()
+    run_id = registry.start_run("A3 {} {}".format(modality, model_type), config={
+        "modality": modality, "model": model_type, "seed": seed, "batch_size_train": batch_size_train,
+        "batch_size_val": batch_size_val, "samples_per_epoch": samples_per_epoch, "folds": [k_low, k_high],
+        "epochs": epochs, "patience": patience, "val_every": val_every, "lr": lr, "final_lr": final_lr,
+        "num_threads": num_threads, "bf16": bf16, "channels_last": channels_last, "num_fold_workers": num_fold_workers,
+        "device": str(device), "ensemble_folds": ensemble_folds, "folds_file": folds_file})
+    # What the fold checkpoints must have been saved with to be resumed, besides the hyperparameters
+    run_config = {"modality": modality, "seed": seed, "folds_file": folds_file, "batch_size_train": batch_size_train,
+                  "batch_size_val": batch_size_val, "samples_per_epoch": samples_per_epoch}
+
     models_and_scores = k_fold_cross_validation(model, k_low=k_low, k_high=k_high, train_data=(p_images_train,
                                                 dataloader_train), val_data=(p_images_validation, dataloader_val),
                                                 epochs=epochs, loss_function=loss_function, lr=lr, softmax=softmax,
-                                                show=True, final_lr=final_lr, device=device)
-    p_images_test = ProstateImages(modality=modality, train=False, device=device)
-    dataloader_test = DataLoader(p_images_test, batch_size=batch_size_test, shuffle=False)
+                                                show=True, final_lr=final_lr, device=device, bf16=bf16,
+                                                channels_last=channels_last,
+                                                num_workers=num_fold_workers, threads_per_worker=num_threads,
+                                                resume_dir=resume_dir if resume else None, run_config=run_config,
+                                                patience=patience,
+                                                val_every=val_every, timing_dir=timing_dir if record_timings else None,
+                                                profile_dir=profile_dir if profile else None, registry=registry,
+                                                run_id=run_id)
+    # Read on the CPU (the workers are forked, see k_fold_cross_validation), test_predictions moves the batches
+    p_images_test = ProstateImages(modality=modality, train=False, device="cpu")
+    dataloader_test = DataLoader(p_images_test, batch_size=batch_size_test, shuffle=False,
+                                 num_workers=num_test_loader_workers, pin_memory=device.type == "cuda",
+                                 multiprocessing_context="fork" if num_test_loader_workers > 0 else None)
 
     # model = CNN(cuda_destination=cuda_destination)
     # model.load_state_dict(torch.load("/home/andrewg/PycharmProjects/assignments/predictions/models/1.pt",
     #                                  map_location=device))
-    # model.cuda(cuda_destination)
-    model = models_and_scores[0][0]
+    # model.to(device)
+    fold_models = [fold_model for fold_model, _ in models_and_scores]
+    model = FoldEnsemble(fold_models) if ensemble_folds else fold_models[0]
 
     model_dir = "/home/andrewg/PycharmProjects/assignments/predictions/models/{}/{}".format(modality, model_type)
     predictions_dir = "/home/andrewg/PycharmProjects/assignments/predictions/prediction_files"
-    sort_key = lambda file_name: int(file_name.split('.')[0])
-    model_files = [f for f in os.listdir(model_dir) if f[0] in '123456789']
-    results_files = [f for f in os.listdir(predictions_dir) if f[0] in '123456789']
-    model_files = sorted(model_files, key=sort_key)
-    results_files = sorted(results_files, key=sort_key)
-
-    if model_files:
-        next_model, _ = model_files[-1].split('.')
-        next_model = "{}.pt".format(int(next_model) + 1)
-    else:
-        next_model = "1.pt"
-
-    if results_files:
-        next_result, _ = results_files[-1].split('.')
-        next_result = "{}.csv".format(int(next_result) + 1)
-    else:
-        next_result = "1.csv"
-
-    results = test_predictions(dataloader_test, model, softmax=softmax)
-    torch.save(models_and_scores[0][0].state_dict(), "{}/{}".format(model_dir, next_model))
+    # Files are numbered by the run that wrote them
+    model_file = "{}/run_{}.pt".format(model_dir, run_id)
+    folds_file = "{}/run_{}_folds.pt".format(model_dir, run_id)  # The state dicts of every fold's model
+    predictions_file = "{}/run_{}.csv".format(predictions_dir, run_id)
+
+    results = test_predictions(dataloader_test, model, softmax=softmax, profile_dir=profile_dir if profile else None)
+    torch.save(fold_models[0].state_dict(), model_file)
+    torch.save([fold_model.state_dict() for fold_model in fold_models], folds_file)
     # unsure_images_ids = results.query("0.45 <= ClinSig <= 0.55").index
     # results.ClinSig.iloc[unsure_images_ids] = results.ClinSig.iloc[unsure_images_ids].apply(lambda x: 0.3)
-    results.to_csv("{}/{}".format(predictions_dir, next_result))
+    results.to_csv(predictions_file)
+    registry.log_artifact(run_id, "model", model_file)
+    registry.log_artifact(run_id, "fold models", folds_file)
+    registry.log_artifact(run_id, "predictions", predictions_file)
+    registry.finish_run(run_id)
@@ -0,0 +1,165 @@
+import glob
+import json
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+from data_helpers import nrrd_to_tensor, compute_cams
+from model_registry import load_model
+from engine import estimate_batch_norm_statistics
+
+CROP_ROOT = "/home/andrewg/PycharmProjects/assignments/resampled_cropped"
+DEFAULT_STORE = "/home/andrewg/PycharmProjects/assignments/predictions/cams"
+CLASS_NAMES = ["non-cancer", "cancer"]
+
+
+def crop_id(file, crop_root=CROP_ROOT):
+    """
+    :param file: The path of a crop
+    :param crop_root: The directory the crops are under
+    :return: The key of the crop in a CamStore, its path relative to crop_root (ex. "train/bval/400_1.nrrd")
+    """
+    return os.path.relpath(os.path.abspath(file), crop_root)
+
+
+class CropFiles(Dataset):
+    """
+    The crops of a list of nrrd files, normalized as in nrrd_to_tensor
+    """
+
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        return {"image": nrrd_to_tensor(self.files[index]).float()}
+
+
+def precompute_cams(model, model_version, files, store_dir=DEFAULT_STORE, crop_root=CROP_ROOT, batch_size=256,
+                    num_workers=0, device="cpu"):
+    """
+    Writes the class activation maps of every crop to the store of a model version, replacing what was there. The maps
+    are kept in float16 ([N, 2, 32, 32], in class order) next to the probabilities, and the crop ids are written last,
+    so a store is only readable once it is complete
+    :param model: The CNN2, its batch norms need running statistics (see engine.estimate_batch_norm_statistics) so that
+                  the maps of a crop do not depend on the other crops in its batch
+    :param model_version: The name the maps are stored under, ex. "bval/CNN2/46"
+    :param files: The crops
+    :param store_dir: The directory holding the stores of every model version
+    :param crop_root: The directory the crops are under, the crop ids are relative to it
+    :param batch_size: The number of crops per forward pass
+    :param num_workers: The number of processes reading the crops
+    :param device: The device the model is on
+    :return: The directory of the store
+    """
+    if not model.batch_norm1.track_running_stats:
+        raise ValueError("The batch norms have no running statistics (the model was loaded from a checkpoint saved "
+                         "before they were registered), give them some with engine.estimate_batch_norm_statistics")
+    directory = "{}/{}".format(store_dir, model_version)
+    os.makedirs(directory, exist_ok=True)
+    index_path = "{}/crop_ids.json".format(directory)
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+
+    data_loader = DataLoader(CropFiles(files), batch_size=batch_size, num_workers=num_workers)
+    probabilities, heatmaps = compute_cams(model, data_loader, device)
+    np.save("{}/heatmaps.npy".format(directory), heatmaps.numpy().astype(np.float16))
+    np.save("{}/probabilities.npy".format(directory), probabilities.numpy())
+    with open(index_path, "w") as f:
+        json.dump([crop_id(file, crop_root) for file in files], f)
+    return directory
+
+
+class CamStore:
+    """
+    Reads the class activation maps precomputed by precompute_cams. The arrays are memory-mapped, so opening a store is
+    cheap and only the maps that are looked at are read from disk
+    """
+
+    def __init__(self, model_version, store_dir=DEFAULT_STORE, crop_root=CROP_ROOT):
+        """
+        :param model_version: The name the maps were stored under, ex. "bval/CNN2/46"
+        :param store_dir: The directory holding the stores of every model version
+        :param crop_root: The directory the crops are under
+        """
+        self.model_version = model_version
+        self.crop_root = crop_root
+        directory = "{}/{}".format(store_dir, model_version)
+        index_path = "{}/crop_ids.json".format(directory)
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError("No class activation maps for {} in {}, write them with cam_store.precompute_cams"
+                                    .format(model_version, store_dir))
+        with open(index_path) as f:
+            self.rows = {crop: row for row, crop in enumerate(json.load(f))}
+        self.heatmaps = np.load("{}/heatmaps.npy".format(directory), mmap_mode="r")
+        self.probabilities = np.load("{}/probabilities.npy".format(directory), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, file):
+        return crop_id(file, self.crop_root) in self.rows
+
+    def _row(self, file):
+        key = crop_id(file, self.crop_root)
+        if key not in self.rows:
+            raise KeyError("{} is not in the store of {}".format(key, self.model_version))
+        return self.rows[key]
+
+    def heatmap(self, file, code=None):
+        """
+        :param file: The path of the crop
+        :param code: The class of the map, defaults to the class predicted for the crop
+        :return: A 32 x 32 float32 array
+        """
+        row = self._row(file)
+        if code is None:
+            code = int(np.argmax(self.probabilities[row]))
+        return np.asarray(self.heatmaps[row, code], dtype=np.float32)
+
+    def class_activation_mapping(self, file):
+        """
+        The stored maps in the format of CNN2.class_activation_mapping, so they can be passed to CNN2.visualize
+        :param file: The path of the crop
+        :return: A 2 x 32 x 32 tensor (the predicted class first) and what each class activation map represents
+        """
+        row = self._row(file)
+        outputs = [float(output) for output in self.probabilities[row]]
+        order = [1, 0] if outputs[0] < outputs[1] else [0, 1]
+        heatmaps = torch.from_numpy(np.asarray(self.heatmaps[row, order], dtype=np.float32))
+        return heatmaps, [(CLASS_NAMES[idx], outputs[idx]) for idx in order]
+
+
+if __name__ == "__main__":
+    from data_helpers import ProstateImages
+
+    modality = "bval"
+    # The (number, modality) of every CNN2 whose maps are stored, a modality of None is an older checkpoint saved
+    # directly in the models directory (cam_visualize.py reads the maps of models/30.pt)
+    stored_models = [(46, modality), (30, None)]
+    splits = ["train", "test", "kgh"]
+    batch_size = 256
+    num_workers = 4
+    num_calibration_crops = 2000  # Training crops used to give old checkpoints batch norm running statistics
+
+    cuda_destination = 0
+    ngpu = 1
+    device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
+
+    p_images = ProstateImages(modality=modality, train=True, device=device, normalize_strategy=1)
+    indices = np.random.default_rng(0).permutation(len(p_images))[:num_calibration_crops]
+    calibration_loader = DataLoader(Subset(p_images, indices), batch_size=100)
+
+    files = []
+    for split in splits:
+        files.extend(sorted(glob.glob("{}/{}/{}/**/*.nrrd".format(CROP_ROOT, split, modality), recursive=True)))
+    for model_number, model_modality in stored_models:
+        model_version = "{}/CNN2/{}".format(model_modality, model_number) if model_modality else str(model_number)
+        model = load_model("CNN2", model_number, model_modality, device=device, cuda_destination=cuda_destination)
+        if not model.batch_norm1.track_running_stats:
+            estimate_batch_norm_statistics(model, calibration_loader, device)
+        directory = precompute_cams(model, model_version, files, batch_size=batch_size, num_workers=num_workers,
+                                    device=device)
+        print("Class activation maps of {} crops written to {}".format(len(files), directory))
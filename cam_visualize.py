@@ -1,36 +1,25 @@
 import torch
 from data_helpers import nrrd_to_tensor
-from models import CNN2
+from cam_store import CamStore
 import matplotlib.pyplot as plt
 import SimpleITK as sitk
 import numpy as np
 from scipy.ndimage import gaussian_filter
 
-seed = 0
-torch.manual_seed(seed)
-if torch.cuda.is_available():
-    torch.cuda.manual_seed_all(0)
-
-cuda_destination = 0
-ngpu = 1
-device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
-
-model = CNN2(0)
-model.cuda(0)
-model.load_state_dict(torch.load("/home/andrewg/PycharmProjects/assignments/predictions/models/30.pt",
-                                 map_location=device))
-model.eval()
+# The maps of models/30.pt, read from the store written by cam_store.py
+store = CamStore("30")
 
 im_num = "400_1.nrrd"
-im3t_bval = nrrd_to_tensor("/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/bval/{}".format(im_num))
+im3t_bval_file = "/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/bval/{}".format(im_num)
+im3t_bval = nrrd_to_tensor(im3t_bval_file)
 im3t_adc = nrrd_to_tensor("/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/adc/{}".format(im_num))
 im3t_t2 = sitk.ReadImage("/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/t2/{}".format(im_num))
 # im3t_t2 = resample_image(im3t_t2, (2, 2, 3))
 im3t_t2 = torch.from_numpy(sitk.GetArrayFromImage(im3t_t2).astype(np.float64))
 
 im_num = "PCAD_005_tz"
-im1_5t_bval = nrrd_to_tensor("/home/andrewg/PycharmProjects/assignments/resampled_cropped/kgh/bval/{}/0.nrrd".format(
-                                                                                                                im_num))
+im1_5t_bval_file = "/home/andrewg/PycharmProjects/assignments/resampled_cropped/kgh/bval/{}/0.nrrd".format(im_num)
+im1_5t_bval = nrrd_to_tensor(im1_5t_bval_file)
 im1_5t_adc = nrrd_to_tensor("/home/andrewg/PycharmProjects/assignments/resampled_cropped/kgh/adc/{}/0.nrrd".format(
                                                                                                                 im_num))
 im1_5t_t2 = nrrd_to_tensor("/home/andrewg/PycharmProjects/assignments/resampled_cropped/kgh/t2/{}/0.nrrd".format(
@@ -58,15 +47,15 @@ for idx in range(3):
 axarr[0, 3].title.set_text("CAM")
 axarr[0, 3].title.set_fontsize(30)
 
-heatmap3t = model.class_activation_mapping(im3t_bval.to(device).float())
-heatmap3t = (heatmap3t[0][0] - heatmap3t[0][0].min()) / (heatmap3t[0][0].max() - heatmap3t[0][0].min())
-heatmap1_5t = model.class_activation_mapping(im1_5t_bval.to(device).float())
-heatmap1_5t = (heatmap1_5t[0][0] - heatmap1_5t[0][0].min()) / (heatmap1_5t[0][0].max() - heatmap1_5t[0][0].min())
+heatmap3t = store.heatmap(im3t_bval_file)
+heatmap3t = (heatmap3t - heatmap3t.min()) / (heatmap3t.max() - heatmap3t.min())
+heatmap1_5t = store.heatmap(im1_5t_bval_file)
+heatmap1_5t = (heatmap1_5t - heatmap1_5t.min()) / (heatmap1_5t.max() - heatmap1_5t.min())
 axarr[0, 3].imshow(images3t[2].numpy()[1], interpolation="bilinear", cmap="gray")
 axarr[1, 3].imshow(images1_5t[2].numpy()[1], interpolation="bilinear", cmap="gray")
 
-heat1 = axarr[0, 3].imshow(heatmap3t.detach().cpu().numpy(), interpolation="bilinear", cmap="jet", alpha=0.6)
-heat2 = axarr[1, 3].imshow(heatmap1_5t.detach().cpu().numpy(), interpolation="bilinear", cmap="jet", alpha=0.6)
+heat1 = axarr[0, 3].imshow(heatmap3t, interpolation="bilinear", cmap="jet", alpha=0.6)
+heat2 = axarr[1, 3].imshow(heatmap1_5t, interpolation="bilinear", cmap="jet", alpha=0.6)
 
 cbar1 = plt.colorbar(heat1, ax=axarr[0, 3], format="%.1f")
 cbar1.solids.set_edgecolor("face")
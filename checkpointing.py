@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import warnings
+import numpy as np
+import torch
+
+
+class StateSnapshot:
+    """
+    Keeps a copy of a model's state_dict in CPU buffers that are allocated once, so taking a snapshot is a copy of the
+    weights into existing memory rather than a deepcopy of the whole module. Snapshots can also be written to disk on a
+    background thread
+    """
+
+    def __init__(self, model, path=None):
+        """
+        :param model: The network whose weights are snapshotted
+        :param path: If given, every snapshot is also saved (asynchronously) to this file with torch.save
+        """
+        pin = torch.cuda.is_available()
+        self.buffers = {name: torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=pin)
+                        for name, tensor in model.state_dict().items()}
+        self.path = path
+        self.taken = False
+        self._writer = ThreadPoolExecutor(max_workers=1) if path else None
+        self._pending = None
+
+    def save(self, model):
+        """
+        Copies the model's current weights into the buffers (and queues a write to self.path)
+        :param model: The network, with the same architecture as the one the snapshot was created for
+        :return: None
+        """
+        self.wait()  # The previous write may still be reading the buffers
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                self.buffers[name].copy_(tensor)
+        self.taken = True
+        if self._writer:
+            self._pending = self._writer.submit(torch.save, self.buffers, self.path)
+
+    def load(self, buffers):
+        """
+        Fills the buffers from a saved state dict, ex. the best weights stored in a training checkpoint
+        :param buffers: A state dict with the same keys as the snapshotted model
+        :return: None
+        """
+        self.wait()
+        for name, tensor in buffers.items():
+            self.buffers[name].copy_(tensor)
+        self.taken = True
+
+    def restore(self, model):
+        """
+        Loads the last snapshot back into the model. If none was taken (ex. every validation was NaN), the model keeps
+        its current weights
+        :param model: The network to load the weights into
+        :return: None
+        """
+        if not self.taken:
+            warnings.warn("No snapshot has been taken, the model keeps its current weights")
+            return
+        model.load_state_dict(self.buffers)
+
+    def wait(self):
+        """
+        Blocks until the last queued write to disk has finished
+        :return: None
+        """
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        """
+        Waits for the last write and stops the thread writing the snapshots, after which the snapshot can still be
+        restored but no longer saved to disk
+        :return: None
+        """
+        self.wait()
+        if self._writer:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
+
+def rng_state():
+    """
+    :return: The states of the torch (CPU and CUDA), numpy and python random number generators
+    """
+    return {"torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "numpy": np.random.get_state(),
+            "random": random.getstate()}
+
+
+def set_rng_state(state):
+    """
+    Restores the random number generators from the output of rng_state
+    :param state: The saved states
+    :return: None
+    """
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+
+def save_training_checkpoint(path, epoch, model, optimizer, history, best, best_snapshot, finished=False, config=None):
+    """
+    Writes everything needed to continue training after the given epoch. The file is written next to path and then
+    renamed, so an interruption during the write never leaves a truncated checkpoint behind
+    :param path: The checkpoint file
+    :param epoch: The number of epochs completed
+    :param model: The network being trained
+    :param optimizer: Its optimizer
+    :param history: The per-epoch metric lists of train_model
+    :param best: The statistics of the best epoch so far
+    :param best_snapshot: The StateSnapshot holding the best weights so far
+    :param finished: Whether training stopped early, in which case resuming only restores the results
+    :param config: A dictionary describing the run (hyperparameters, data...), checked by load_training_checkpoint
+    :return: None
+    """
+    checkpoint = {"epoch": epoch,
+                  "finished": finished,
+                  "config": config,
+                  "model": model.state_dict(),
+                  "optimizer": optimizer.state_dict(),
+                  "rng": rng_state(),
+                  "history": history,
+                  "best": best,
+                  "best_weights": best_snapshot.buffers if best_snapshot.taken else None}
+    temporary_path = "{}.tmp".format(path)
+    torch.save(checkpoint, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_training_checkpoint(path, model, optimizer, best_snapshot, config=None):
+    """
+    Restores a checkpoint written by save_training_checkpoint into the model, optimizer, random number generators and
+    snapshot of the best weights
+    :param path: The checkpoint file
+    :param model: The network, built the same way as the one that was checkpointed
+    :param optimizer: Its optimizer
+    :param best_snapshot: The StateSnapshot the best weights are loaded into
+    :param config: If given, the description of the run resuming, which must be the one the checkpoint was saved with
+    :return: The checkpoint dictionary (epoch, finished, history and best are the entries of interest)
+    """
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if config is not None and checkpoint.get("config") != config:
+        raise ValueError("{} was saved by a run configured with {}, not {}. Delete it or resume from another directory"
+                         .format(path, checkpoint.get("config"), config))
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    set_rng_state(checkpoint["rng"])
+    if checkpoint["best_weights"] is not None:
+        best_snapshot.load(checkpoint["best_weights"])
+    return checkpoint
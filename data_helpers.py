@@ -1,18 +1,26 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, Subset
 import os
 import SimpleITK as sitk
 import numpy as np
 import adabound
 import matplotlib.pyplot as plt
-from sklearn.metrics import f1_score, auc, roc_curve, roc_auc_score, confusion_matrix
+from sklearn.metrics import roc_curve, roc_auc_score
 import random
+import math
 from image_augmentation import rotation3d
 import shutil
 import pandas as pd
-import copy
 from models import CNN2
+from metrics import BinaryMetrics
+from checkpointing import StateSnapshot, save_training_checkpoint, load_training_checkpoint
+from engine import autocast, configure_threads, prepare_model, EarlyStopping
+from profiling import PhaseTimer, EpochClock, StepProfiler
+from run_registry import RunLog
+from model_registry import load_weights, cnn2_initialization
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 
 def resample_image(itk_image, out_spacing, is_label=False):
@@ -123,17 +131,16 @@ def rotated_crop(patient_images, crop_width, crop_height, crop_depth, degrees, l
     return crop
 
 
-def write_cropped_images_train_and_folds(cropped_images, num_crops, num_folds=5, fold_fraction=0.2):
+def write_cropped_images_train_and_folds(cropped_images, num_folds=5, seed=0):
     """
-    This function writes all cropped images to a training directory (for each modality) and creates a list of hashmaps
-    for folds. These maps ensure that there is a balanced distribution of cancer and non-cancer in each validation set
-    as well as the training set used for prediction.
+    This function writes all cropped images to a training directory (for each modality) and creates the train and
+    validation index arrays for each fold. Every patient is kept, and a patient's crops are never split across a train
+    and validation set; class balance is left to the sampler (see stratified_group_folds).
     :param cropped_images: A dictionary where the keys are the patient IDs, and the values are lists where each element
     is a list of length three (first element in that list is t2 image, and then adc and bval).
-    :param num_crops: The number of crops for a given patient's image
     :param num_folds: The number of sets to be created
-    :param fold_fraction: The amount of cancer patients to be within a fold's validation set
-    :return: fold key and train key mappings (lists of hash functions which map to the correct patient data)
+    :param seed: Seed for the fold assignment, the same seed always gives the same folds
+    :return: fold and train indices (lists of sorted int64 arrays of image indices in the training directory)
     """
 
     destination = r"/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/"
@@ -155,63 +162,83 @@ def write_cropped_images_train_and_folds(cropped_images, num_crops, num_folds=5,
         sitk.WriteImage(patient_image[1], destination.format("adc", p_id, cancer_marker))
         sitk.WriteImage(patient_image[2], destination.format("bval", p_id, cancer_marker))
 
-    patient_indices = set(range(len(patient_images) // num_crops))
-    non_cancer_patients = {idx for idx in patient_indices if patient_images[idx * num_crops][0][-1] == '0'}
-    cancer_patients = {idx for idx in patient_indices if patient_images[idx * num_crops][0][-1] == '1'}
+    # Keys are of the form patient_id_cancermarker, the same patient can appear under both markers
+    labels = np.array([cancer_marker for _, (_, cancer_marker) in patient_images], dtype=np.int64)
+    patient_ids = np.array([key.rsplit('_', 1)[0] for key, _ in patient_images])
 
-    num_each_class_fold = int(fold_fraction * len(cancer_patients))
+    train_indices, fold_indices = stratified_group_folds(labels, patient_ids, num_folds=num_folds, seed=seed)
+    return fold_indices, train_indices
 
-    fold_key_mappings = []
-    train_key_mappings = []
-    for k in range(num_folds):
 
-        non_cancer_in_fold = random.sample(non_cancer_patients, num_each_class_fold)
-        cancer_in_fold = random.sample(cancer_patients, num_each_class_fold)
-
-        fold_set = set()
-        fold_set.update(non_cancer_in_fold)
-        fold_set.update(cancer_in_fold)
+def stratified_group_folds(labels, groups, num_folds=5, seed=0):
+    """
+    Patient-grouped, stratified K-fold assignment. Each group (patient) gets the label of its most severe image, the
+    groups of each class are shuffled with a seeded NumPy generator and then dealt out to the folds in turn, so every
+    fold gets the same share (give or take one patient) of each class and all of a patient's images land in one fold.
+    :param labels: An integer array with the label of every image
+    :param groups: An array (same length as labels) with the patient id of every image
+    :param num_folds: The number of folds
+    :param seed: Seed for numpy.random.default_rng
+    :return: Two lists of length num_folds containing sorted int64 arrays, the training indices and the validation
+             indices of each fold
+    """
+    labels = np.asarray(labels)
+    unique_groups, image_group = np.unique(np.asarray(groups), return_inverse=True)
+    assert num_folds <= len(unique_groups)
 
-        out_of_fold = patient_indices.difference(fold_set)
+    group_labels = np.zeros(len(unique_groups), dtype=labels.dtype)
+    np.maximum.at(group_labels, image_group, labels)
 
-        # Uses up all the cancer patients
-        cancer_out_of_fold = {idx for idx in out_of_fold if patient_images[idx * num_crops][0][-1] == '1'}
-        non_cancer_out_of_fold = random.sample(out_of_fold.difference(cancer_out_of_fold), len(cancer_out_of_fold))
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(unique_groups))
+    order = order[np.argsort(group_labels[order], kind="stable")]  # Shuffled within each class, classes contiguous
+    group_fold = np.empty(len(unique_groups), dtype=np.int64)
+    group_fold[order] = np.arange(len(unique_groups)) % num_folds
 
-        out_of_fold_set = set()
-        out_of_fold_set.update(cancer_out_of_fold)
-        out_of_fold_set.update(non_cancer_out_of_fold)
+    image_fold = group_fold[image_group]
+    by_fold = np.argsort(image_fold, kind="stable")
+    fold_indices = np.split(by_fold, np.cumsum(np.bincount(image_fold, minlength=num_folds))[:-1])
+    train_indices = [np.flatnonzero(image_fold != k) for k in range(num_folds)]
+    return train_indices, fold_indices
 
-        # Prepare fold indices
-        fold_image_indices = set()
-        for key in fold_set:
-            image_index = key * num_crops
-            for pos in range(num_crops):
-                fold_image_indices.add(image_index + pos)
 
-        # Prepare train key indices
-        out_of_fold_image_indices = set()
-        for key in out_of_fold_set:
-            image_index = key * num_crops
-            for pos in range(num_crops):
-                out_of_fold_image_indices.add(image_index + pos)
+def save_folds(path, train_indices, fold_indices):
+    """
+    Stores the train and validation index arrays of every fold in a single .npz file, under the keys train_k and val_k
+    :param path: Where the .npz file is written
+    :param train_indices: A list where the kth element is the array of training image indices for fold k
+    :param fold_indices: A list where the kth element is the array of validation image indices for fold k
+    :return: None
+    """
+    assert len(train_indices) == len(fold_indices)
+    arrays = {}
+    for k, (train_fold, val_fold) in enumerate(zip(train_indices, fold_indices)):
+        arrays["train_{}".format(k)] = np.asarray(train_fold, dtype=np.int64)
+        arrays["val_{}".format(k)] = np.asarray(val_fold, dtype=np.int64)
+    np.savez(path, **arrays)
 
-        fold_key_mapping = {}
-        key = 0
-        for fold_image_index in fold_image_indices:
-            fold_key_mapping[key] = fold_image_index
-            key += 1
 
-        train_key_mapping = {}
-        key = 0
-        for train_image_index in out_of_fold_image_indices:
-            train_key_mapping[key] = train_image_index
-            key += 1
+def load_folds(path):
+    """
+    Reads the folds written by save_folds
+    :param path: The .npz file
+    :return: Two lists of arrays, the training indices and the validation indices of each fold
+    """
+    with np.load(path) as folds:
+        num_folds = len(folds.files) // 2
+        train_indices = [folds["train_{}".format(k)] for k in range(num_folds)]
+        fold_indices = [folds["val_{}".format(k)] for k in range(num_folds)]
+    return train_indices, fold_indices
 
-        fold_key_mappings.append(fold_key_mapping)
-        train_key_mappings.append(train_key_mapping)
 
-    return fold_key_mappings, train_key_mappings
+def key_mappings_to_folds(key_mappings):
+    """
+    Converts the pickled dictionary key mappings of older runs ({0: idx, 1: idx, ...} per fold) into index arrays
+    :param key_mappings: A list of dictionaries, one per fold
+    :return: A list of int64 arrays, one per fold
+    """
+    return [np.fromiter((mapping[key] for key in sorted(mapping)), dtype=np.int64, count=len(mapping))
+            for mapping in key_mappings]
 
 
 def image_cropper(findings_dataframe, resampled_images, padding,
@@ -302,10 +329,11 @@ def image_cropper(findings_dataframe, resampled_images, padding,
 class ProstateImages(Dataset):
     """
     This class's sole purpose is to provide the framework for fetching training/test data for the data loader which
-    uses this class as a parameter
+    uses this class as a parameter. For training data, index i is the image i_{0,1}.nrrd in the training directory, and
+    folds are selected by wrapping the dataset in a FoldSubset
     """
 
-    def __init__(self, modality, train, device, normalize_strategy=1, mapping=None):
+    def __init__(self, modality, train, device, normalize_strategy=1):
         assert modality in ["t2", "bval", "adc"]
         assert normalize_strategy in [1, 2]
         self.modality = modality
@@ -328,12 +356,14 @@ class ProstateImages(Dataset):
             self.std_tensor = np.load(std_path)
 
         if self.train:
-            self.mapping = mapping
-            self.map_num = 0
-
-            # The 0th index may vary depending on the first key of the hash function
-            self.first_index = sorted(self.mapping[self.map_num])[0]
-            self.length = len(self.mapping[self.map_num])
+            path = "/home/andrewg/PycharmProjects/assignments/resampled_cropped/train/{}/".format(self.modality)
+
+            # The last digit in the file name specifies cancer/non-cancer, so the labels are read off the listing once
+            image_files = [file_name.split('.')[0].split('_') for file_name in os.listdir(path)]
+            self.length = len(image_files)
+            self.labels = np.zeros(self.length, dtype=np.int64)
+            for index, cancer_label in image_files:
+                self.labels[int(index)] = int(cancer_label)
         else:
             path = "/home/andrewg/PycharmProjects/assignments/resampled_cropped/test/{}/".format(self.modality)
             sorted_path = sorted(os.listdir(path))
@@ -343,27 +373,14 @@ class ProstateImages(Dataset):
     def __len__(self):
         return self.length
 
-    def change_map_num(self, new_map_num):
-        self.map_num = new_map_num
-        self.first_index = sorted(self.mapping[self.map_num])[0]
-        self.length = len(self.mapping[self.map_num])
-
     def __getitem__(self, index):
         if self.train:
-            index = self.mapping[self.map_num][index + self.first_index]
+            cancer_label = int(self.labels[index])
             path = "{}/{}".format(
                 "/home/andrewg/PycharmProjects/assignments/resampled_cropped/train",
-                "{}/{}_{}.nrrd".format(self.modality, index, "{}")
+                "{}/{}_{}.nrrd".format(self.modality, index, cancer_label)
             )
-            try:
-                final_path = path.format(0)
-                image = sitk.ReadImage(final_path)
-            except:
-                final_path = path.format(1)
-                image = sitk.ReadImage(final_path)
-
-            # The last digit in the file name specifies cancer/non-cancer
-            cancer_label = int(final_path.split('.')[0][-1])
+            image = sitk.ReadImage(path)
             output = {"image": image, "cancer": cancer_label}
 
         else:
@@ -390,6 +407,67 @@ class ProstateImages(Dataset):
         return output
 
 
+class FoldSubset(Subset):
+    """
+    A view of a dataset restricted to one fold's index array. Switching folds only swaps the index array, so a
+    DataLoader built on a FoldSubset picks up the new fold on its next iteration
+    """
+
+    def __init__(self, dataset, folds, map_num=0):
+        """
+        :param dataset: The full dataset, ex. a ProstateImages object where train=True
+        :param folds: A list where the kth element is the index array of fold k (see load_folds)
+        :param map_num: The fold to start on
+        """
+        self.folds = folds
+        self.map_num = map_num
+        super(FoldSubset, self).__init__(dataset, folds[map_num])
+
+    def change_map_num(self, new_map_num):
+        self.map_num = new_map_num
+        self.indices = self.folds[new_map_num]
+
+
+def dataset_labels(dataset):
+    """
+    Returns the label of every item of a dataset, looking through (possibly nested) Subsets
+    :param dataset: A dataset with a labels array (ex. ProstateImages where train=True, KGHProstateImages), or a
+                    Subset of one
+    :return: An int64 array with one label per item of dataset
+    """
+    if isinstance(dataset, Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    return np.asarray(dataset.labels, dtype=np.int64)
+
+
+class ClassBalancedSampler(Sampler):
+    """
+    Draws num_samples indices per epoch, with replacement, such that every class is equally likely to be drawn. All of
+    the data stays available to the model, and the length (and cost) of an epoch is set by num_samples rather than by
+    how many patients of each class there are
+    """
+
+    def __init__(self, data_source, num_samples=None, generator=None):
+        """
+        :param data_source: The dataset being sampled from (see dataset_labels). The labels are read at the start of
+                            every epoch, so FoldSubset.change_map_num is picked up
+        :param num_samples: The number of samples per epoch, defaults to the length of data_source
+        :param generator: Optional torch.Generator used for sampling
+        """
+        self.data_source = data_source
+        self.num_samples = num_samples
+        self.generator = generator
+
+    def __len__(self):
+        return self.num_samples if self.num_samples is not None else len(self.data_source)
+
+    def __iter__(self):
+        labels = dataset_labels(self.data_source)
+        _, classes, class_counts = np.unique(labels, return_inverse=True, return_counts=True)
+        weights = torch.from_numpy(1 / class_counts[classes])
+        yield from torch.multinomial(weights, len(self), replacement=True, generator=self.generator).tolist()
+
+
 def he_initialize(model):
     """
     He weight initialization, as described in Delving Deep into Rectifiers:Surpassing Human-Level Performance on
@@ -407,7 +485,7 @@ def he_initialize(model):
             torch.nn.init.kaiming_normal_(model.bias)
 
 
-def flatten_batch(image_shape, images, class_vector, cuda_destination):
+def flatten_batch(image_shape, images, class_vector, device):
     """
     For example, if you have shape [batch_size, num_images_per_patient, width, height, length], then
     this makes duplicates such that if a patient has cancer, instead of having 1 cancer label, they
@@ -417,18 +495,19 @@ def flatten_batch(image_shape, images, class_vector, cuda_destination):
     :param image_shape: The total shape of the batch
     :param images: Batches of images with one extra dimension
     :param class_vector: Cancer label vector
-    :param cuda_destination: The gpu that the model is using
+    :param device: The device that the model is using
     :return: The flattened images and the lengthened class vector
     """
 
-    class_vector = torch.tensor([[class_vector[idx]] * image_shape[1] for idx in
-                                 range(image_shape[0])]).float().cuda(cuda_destination).unsqueeze(1)
-    class_vector = class_vector.view(-1).unsqueeze(1)
+    class_vector = class_vector.float().to(device).view(-1).repeat_interleave(image_shape[1]).unsqueeze(1)
     images = images.view(images.shape[0] * images.shape[1], *images.shape[2:])
     return images, class_vector
 
 
-def train_model(train_data, val_data, model, epochs, optimizer, loss_function, softmax=False, show=False):
+def train_model(train_data, val_data, model, epochs, optimizer, loss_function, softmax=False, show=False,
+                checkpoint_path=None, device=None, bf16=False, channels_last=False, resume_path=None, resume_every=1,
+                resume_config=None, patience=None, min_delta=0.0, monitor="auc", val_every=1, initialize=True,
+                timing_log=None, profile_dir=None, profile_window=(1, 1, 5), run_log=None):
     """
     This function trains a model with batches of a given size, and if show=True, plots the loss, f1, and auc scores for
     the training and validation sets
@@ -442,194 +521,365 @@ def train_model(train_data, val_data, model, epochs, optimizer, loss_function, s
     :param num_folds: How many folds were chosen to be
     :param show: Whether or not the user wants to see plots of loss, f1, and auc scores for the training and validation
                  sets
-    :return: AUC and F1 train, AUC and F1 validation
+    :param checkpoint_path: If given, the best weights are also written to this file (in the background) whenever the
+                            monitored validation metric improves
+    :param device: The device to train on, defaults to the device of the model's parameters
+    :param bf16: Whether to run the forward passes under bfloat16 autocast (see engine.autocast)
+    :param channels_last: Whether the 2D convolution weights are converted to the channels-last memory format (see
+                          engine.prepare_model). The batches are left as they are, their second dimension is the depth
+                          the Conv3d of every network convolves over, not channels
+    :param resume_path: If given, the training state (model, optimizer, random number generators and metric history)
+                        is saved to this file every resume_every epochs. If the file already exists, training continues
+                        from it up to epochs (which may be larger than in the previous call, but not smaller), and a
+                        run that reached epochs or stopped early just returns its results
+    :param resume_every: How many epochs pass between training checkpoints
+    :param resume_config: If given, a dictionary describing the run (hyperparameters, data, seed...) that is stored in
+                          the training checkpoint. Resuming from a checkpoint saved with a different one raises a
+                          ValueError, so a changed run never continues from the weights of another
+    :param patience: If given, training stops once the monitored validation metric has not improved by more than
+                     min_delta for this many validations, and the best weights are restored
+    :param min_delta: The smallest change of the monitored metric that counts as an improvement
+    :param monitor: The validation metric that decides which epoch's weights are the best and that early stopping
+                    watches, "auc", "f1" or "loss"
+    :param val_every: The validation set is evaluated every val_every epochs (and after the last epoch)
+    :param initialize: If softmax, whether the convolutions are first initialized from the bval CNN (see
+                       initialize_CNN2). Turn off when the model already holds pretrained weights
+    :param timing_log: If given, the time spent loading batches (__getitem__ and collation), copying them to the
+                       device, in the forward and backward passes, the optimizer, the metrics and checkpointing, and the
+                       samples per second, are appended to this JSON lines file once per epoch (see
+                       profiling.PhaseTimer and profiling.summarize_timings)
+    :param profile_dir: If given, a window of training steps is profiled with torch.profiler, and its Chrome trace and
+                        top operator table are written to this directory (see profiling.StepProfiler)
+    :param profile_window: The (wait, warmup, active) training steps of the profiling window
+    :param run_log: If given, a run_registry.RunLog that every epoch's metrics, wall time and samples are recorded in
+                    (and its phase timings, with timing_log)
+    :return: The model (with the weights of its best epoch restored), and the confusion matrix, AUC and F1 train, AUC
+             and F1 validation of that epoch
     """
 
-    if softmax:
+    if softmax and initialize:
         initialize_CNN2(model, "bval")
-    errors = []
-    eval_errors = []
-    f1_train = []
-    auc_train = []
-    f1_eval = []
-    auc_eval = []
+    history = {"errors": [], "eval_errors": [], "f1_train": [], "auc_train": [], "f1_eval": [], "auc_eval": [],
+               "eval_epochs": []}
+    best = {"auc": 0, "f1": None, "auc_train": None, "f1_train": None, "confusion_matrix": None}
     num_training_batches = len(train_data)
-    best_auc = 0
-    for epoch in range(epochs):
+    if device is None:
+        device = next(model.parameters()).device
+    if channels_last:
+        prepare_model(model, device, channels_last=True)
+    train_metrics = BinaryMetrics(device)
+    val_metrics = BinaryMetrics(device)
+    best_snapshot = StateSnapshot(model, path=checkpoint_path)
+    assert monitor in ["auc", "f1", "loss"]
+    # Also picks the best epoch, so it tracks the monitored metric even when training never stops early
+    early_stopping = EarlyStopping(patience if patience else math.inf, min_delta,
+                                   mode="min" if monitor == "loss" else "max")
+    timer = PhaseTimer(device, log_path=timing_log, enabled=timing_log is not None)
+    # Without the phase timings, a run still records the wall time and samples of every epoch
+    clock = EpochClock(device, enabled=run_log is not None and timing_log is None)
+    profiler = StepProfiler(profile_dir, "train", device, window=profile_window, enabled=profile_dir is not None)
+
+    start_epoch = 0
+    finished = False
+    if resume_path and os.path.exists(resume_path):
+        checkpoint = load_training_checkpoint(resume_path, model, optimizer, best_snapshot, config=resume_config)
+        start_epoch, finished, history, best = (checkpoint["epoch"], checkpoint["finished"], checkpoint["history"],
+                                                checkpoint["best"])
+        if start_epoch > epochs:
+            raise ValueError("{} was saved after {} epochs, more than the {} asked for".format(resume_path, start_epoch,
+                                                                                              epochs))
+        print("Resuming from {} after epoch {}".format(resume_path, start_epoch))
+        if "early_stopping" in best:
+            early_stopping.load_state_dict(best["early_stopping"])
+        elif monitor == "auc" and best["auc_train"] is not None:  # Saved while only early stopping was tracked
+            early_stopping.best = best["auc"]
+    if finished:
+        start_epoch = epochs
+
+    profiler.start()
+    clock.start()
+    for epoch in range(start_epoch, epochs):
         model.train()  # Training mode
         train_iter = iter(train_data)
         model.zero_grad()
-        train_loss = 0
-        all_preds = []
-        all_actual = []
+        train_metrics.reset()
+        timer.synchronize()
         for batch_num in range(num_training_batches):
-            batch = next(train_iter)
-            images, class_vector = batch["image"], batch["cancer"].float().cuda(model.cuda_destination).unsqueeze(1)
-            image_shape = images.shape
-            if len(image_shape) != 4:
-                images, class_vector = flatten_batch(image_shape, images, class_vector, model.cuda_destination)
-            optimizer.zero_grad()
-            preds = model(images)
-
-            class_vector = class_vector.squeeze(1)
-
-            if softmax:
-                class_vector = class_vector.long()
-
-            loss = loss_function(preds, class_vector)
-
-            if softmax:
-                hard_preds = torch.tensor([torch.argmax(tup) for tup in preds])
-            else:
-                hard_preds = torch.round(preds)
-
-            all_preds.extend(hard_preds.squeeze(-1).tolist())
-            try:
-                all_actual.extend(class_vector.squeeze(-1).tolist())
-            except:
-                all_actual.append(class_vector.squeeze(-1).tolist())
-            train_loss += loss.item()
-            loss.backward()
-            optimizer.step()
-        train_loss_avg = train_loss / num_training_batches
-        f1_train.append(f1_score(all_actual, all_preds))
-        fpr, tpr, _ = roc_curve(all_actual, all_preds, pos_label=1)
-        auc_train.append(auc(fpr, tpr))
-        errors.append(train_loss_avg)
-        model.eval()  # Evaluation mode
-        num_val_batches = len(val_data)
-        val_iter = iter(val_data)
-        eval_loss = 0
-        all_preds = []
-        all_actual = []
-        with torch.no_grad():
-            for batch_num in range(num_val_batches):
-                batch = next(val_iter)
-                images, class_vector = batch["image"], batch["cancer"].float().cuda(model.cuda_destination).unsqueeze(1)
+            with timer.phase("train/data"):
+                batch = next(train_iter)
+            with timer.phase("train/copy"):
+                images, class_vector = batch["image"].to(device), batch["cancer"].float().to(device).unsqueeze(1)
                 image_shape = images.shape
                 if len(image_shape) != 4:
-                    images, class_vector = flatten_batch(image_shape, images, class_vector, model.cuda_destination)
-                preds = model(images)
+                    images, class_vector = flatten_batch(image_shape, images, class_vector, device)
+            with timer.phase("train/forward"):
+                optimizer.zero_grad()
+                with autocast(device, bf16):
+                    preds = model(images)
+                preds = preds.float()
+
                 class_vector = class_vector.squeeze(1)
+
                 if softmax:
                     class_vector = class_vector.long()
-                loss = loss_function(preds, class_vector)
-                eval_loss += loss.item()
-                if softmax:
-                    hard_preds = torch.tensor([torch.argmax(tup) for tup in preds])
                 else:
-                    hard_preds = torch.round(preds)
-                all_preds.extend(hard_preds.squeeze(-1).tolist())
-                try:
-                    all_actual.extend(class_vector.squeeze(-1).tolist())
-                except:
-                    all_actual.append(class_vector.squeeze(-1).tolist())
-
-        eval_loss_avg = eval_loss / num_val_batches
-        print("Loss Epoch {}, Training: {}, Validation: {}".format(epoch + 1, train_loss_avg, eval_loss_avg))
-        f1_eval.append(f1_score(all_actual, all_preds))
-        fpr, tpr, _ = roc_curve(all_actual, all_preds, pos_label=1)
-        auc_eval.append(auc(fpr, tpr))
-
-        if auc_eval[-1] > best_auc:
-            auc_train_of_best_model = auc_train[-1]
-            f1_train_of_best_model = f1_train[-1]
-
-            conf_matrix = confusion_matrix(all_actual, all_preds)
-            best_auc = auc_eval[-1]
-            best_f1 = f1_eval[-1]
-            best_model = copy.deepcopy(model)
-        eval_errors.append(eval_loss_avg)
+                    preds = preds.view(-1)  # BCELoss needs the input and target to have the same shape
+
+                loss = loss_function(preds, class_vector)
+            with timer.phase("train/metrics"):
+                train_metrics.update(preds, class_vector, loss)
+            with timer.phase("train/backward"):
+                loss.backward()
+            with timer.phase("train/optimizer"):
+                optimizer.step()
+            timer.add_samples("train", len(images))
+            clock.add_samples("train", len(images))
+            profiler.step()
+        with timer.phase("train/metrics"):
+            train_stats = train_metrics.compute()
+        train_loss_avg = train_stats["loss"]
+        history["f1_train"].append(train_stats["f1"])
+        history["auc_train"].append(train_stats["auc"])
+        history["errors"].append(train_loss_avg)
+        validate = (epoch + 1) % val_every == 0 or epoch + 1 == epochs
+        if not validate:
+            print("Loss Epoch {}, Training: {}".format(epoch + 1, train_loss_avg))
+            continue_training = True
+        else:
+            model.eval()  # Evaluation mode
+            num_val_batches = len(val_data)
+            val_iter = iter(val_data)
+            val_metrics.reset()
+            with torch.no_grad():
+                for batch_num in range(num_val_batches):
+                    with timer.phase("validation/data"):
+                        batch = next(val_iter)
+                    with timer.phase("validation/copy"):
+                        images = batch["image"].to(device)
+                        class_vector = batch["cancer"].float().to(device).unsqueeze(1)
+                        image_shape = images.shape
+                        if len(image_shape) != 4:
+                            images, class_vector = flatten_batch(image_shape, images, class_vector, device)
+                    with timer.phase("validation/forward"):
+                        with autocast(device, bf16):
+                            preds = model(images)
+                        preds = preds.float()
+                        class_vector = class_vector.squeeze(1)
+                        if softmax:
+                            class_vector = class_vector.long()
+                        else:
+                            preds = preds.view(-1)
+                        loss = loss_function(preds, class_vector)
+                    with timer.phase("validation/metrics"):
+                        val_metrics.update(preds, class_vector, loss)
+                    timer.add_samples("validation", len(images))
+                    clock.add_samples("validation", len(images))
+
+            with timer.phase("validation/metrics"):
+                val_stats = val_metrics.compute()
+            eval_loss_avg = val_stats["loss"]
+            print("Loss Epoch {}, Training: {}, Validation: {}".format(epoch + 1, train_loss_avg, eval_loss_avg))
+            history["f1_eval"].append(val_stats["f1"])
+            history["auc_eval"].append(val_stats["auc"])
+
+            continue_training = not early_stopping.step(val_stats[monitor])
+            if early_stopping.improved:
+                best["auc_train"] = history["auc_train"][-1]
+                best["f1_train"] = history["f1_train"][-1]
+                best["confusion_matrix"] = val_stats["confusion_matrix"]
+                best["auc"] = history["auc_eval"][-1]
+                best["f1"] = history["f1_eval"][-1]
+                with timer.phase("checkpoint"):
+                    best_snapshot.save(model)
+            history["eval_errors"].append(eval_loss_avg)
+            history["eval_epochs"].append(epoch)
+
+            if not continue_training:
+                print("Stopping early, validation {} has not improved in {} validations".format(monitor, patience))
+
+        finished = not continue_training
+        if resume_path and ((epoch + 1) % resume_every == 0 or epoch + 1 == epochs or finished):
+            best["early_stopping"] = early_stopping.state_dict()
+            with timer.phase("checkpoint"):
+                save_training_checkpoint(resume_path, epoch + 1, model, optimizer, history, best, best_snapshot,
+                                         finished=finished, config=resume_config)
+        timing = timer.end_epoch(epoch + 1) or clock.end_epoch(epoch + 1)
+        if run_log:
+            run_log.log_epoch(epoch + 1, train_stats, val_stats if validate else None, timing)
+        if finished:
+            break
+    profiler.stop()
 
     if show:
-        plt.plot(errors)
-        plt.plot(eval_errors)
+        plt.plot(history["errors"])
+        plt.plot(history["eval_epochs"], history["eval_errors"])
         plt.title("Training (blue) vs Cross-Validation (orange) Error (BCELoss)")
         plt.legend(["training loss", "validation loss"])
         plt.show()
-        plt.plot(f1_train)
-        plt.plot(f1_eval)
+        plt.plot(history["f1_train"])
+        plt.plot(history["eval_epochs"], history["f1_eval"])
         plt.legend(["training f1", "validation f1"])
         plt.title("F1 Training vs F1 Cross-Validation")
         plt.show()
-        plt.plot(auc_train)
-        plt.plot(auc_eval)
+        plt.plot(history["auc_train"])
+        plt.plot(history["eval_epochs"], history["auc_eval"])
         plt.legend(["training auc", "validation auc"])
         plt.title("AUC Training vs AUC Cross-Validation")
         plt.show()
 
-    print("The best AUC on the validation set during training was {}".format(best_auc))
-    return best_model, conf_matrix, auc_train_of_best_model, f1_train_of_best_model, best_auc, best_f1
+    best_snapshot.restore(model)
+    best_snapshot.close()
+    print("The best validation {} during training was {} (AUC {})".format(monitor, early_stopping.best, best["auc"]))
+    return model, best["confusion_matrix"], best["auc_train"], best["f1_train"], best["auc"], best["f1"]
+
+
+def train_fold(k, network, train_data, val_data, epochs, loss_function, device, lr, final_lr, weight_decay, softmax,
+               plot, cuda_destination, bf16, channels_last, pretrained_state, resume_dir, resume_config, patience,
+               val_every, timing_dir, profile_dir, registry, run_id):
+    """
+    Trains a freshly built model on fold k (see k_fold_cross_validation for the parameters)
+    :param k: The fold to train on
+    :param plot: Whether train_model shows its loss, f1 and auc plots
+    :param pretrained_state: A state dict the new model starts from, or None for a random initialisation. The batch
+                             norms of a legacy checkpoint start from fresh running statistics
+    :param resume_dir: If given, the fold is checkpointed to (and resumed from) resume_dir/fold_k.pt
+    :param resume_config: The description of the run its checkpoint must have been saved with (see train_model)
+    :param timing_dir: If given, the fold's per-epoch phase timings are appended to timing_dir/fold_k.jsonl
+    :param profile_dir: If given, the fold's profiler traces are written to profile_dir/fold_k
+    :param registry: If given, the fold's epochs are recorded under run_id in this run_registry.RunRegistry
+    :return: The trained model and its (auc train, f1 train, auc validation, f1 validation) scores
+    """
+    print("Fold {}".format(k + 1))
+    train_data, train_dataloader = train_data
+    val_data, val_dataloader = val_data
+    model = network(cuda_destination)
+    if pretrained_state is not None:
+        model.load_state_dict(pretrained_state)
+        model.restore_running_statistics()
+    model.to(device)
+    # optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum, weight_decay=weight_decay)
+    # optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+    optimizer = adabound.AdaBound(model.parameters(), lr=lr, final_lr=final_lr, weight_decay=weight_decay)
+    resume_path = "{}/fold_{}.pt".format(resume_dir, k) if resume_dir else None
+    timing_log = "{}/fold_{}.jsonl".format(timing_dir, k) if timing_dir else None
+    fold_profile_dir = "{}/fold_{}".format(profile_dir, k) if profile_dir else None
+    train_data.change_map_num(k)
+    val_data.change_map_num(k)
+    model, _, auc_train, f1_train, auc_eval, f1_eval = train_model(train_dataloader, val_dataloader, model, epochs,
+                                                                   optimizer, loss_function, softmax=softmax,
+                                                                   show=plot, device=device, bf16=bf16,
+                                                                   channels_last=channels_last,
+                                                                   resume_path=resume_path,
+                                                                   resume_config=resume_config, patience=patience,
+                                                                   val_every=val_every, timing_log=timing_log,
+                                                                   profile_dir=fold_profile_dir,
+                                                                   run_log=RunLog(registry, run_id, k) if registry
+                                                                   else None)
+    return model, (auc_train, f1_train, auc_eval, f1_eval)
+
+
+_fold_job = None  # The train_fold arguments shared with forked fold workers, set by k_fold_cross_validation
+
+
+def _fold_worker_init(num_threads):
+    configure_threads(num_threads)
+
+
+def _run_fold_job(k):
+    model, fold_scores = train_fold(k, **_fold_job)
+    return {name: tensor.cpu() for name, tensor in model.state_dict().items()}, fold_scores
 
 
 def k_fold_cross_validation(network, k_low, k_high, train_data, val_data, epochs, loss_function, device, lr=0.005,
                             final_lr=0.05, momentum=0.9, weight_decay=0.04, softmax=False,
-                            show=True, cuda_destination=1):
+                            show=True, cuda_destination=1, bf16=False, channels_last=False, num_workers=1,
+                            threads_per_worker=None, resume_dir=None, run_config=None, patience=None, val_every=1,
+                            timing_dir=None, profile_dir=None, registry=None, run_id=None):
     """
-    Given training and validation data, performs K-fold cross-validation.
+    Given training and validation data, performs K-fold cross-validation. Every fold trains its own model, built from
+    the same pretrained weights, so the folds are independent and can be run concurrently in separate processes.
     :param network: Instance of the class you will use as the network
     :param K: Number of folds
-    :param train_data: A tuple containing a ProstateImages object where train=True and a dataloader in which
-                       the ProstateImages object is supplied as a parameter
-    :param val_data: A tuple containing a ProstateImages object where train=True and a dataloader in which
-                     the ProstateImages object is supplied as a parameter
+    :param train_data: A tuple containing a FoldSubset of the training folds and a dataloader in which the FoldSubset
+                       is supplied as a parameter
+    :param val_data: A tuple containing a FoldSubset of the validation folds and a dataloader in which the FoldSubset
+                     is supplied as a parameter
     :param epochs: The number of epochs each model is to be trained for
     :param loss_function: The desired loss function which is to be used by every model being trained
     :param lr: The learning rate, default is 0.005
     :param momentum: The momentum for stochastic gradient descent, default is 0.9
     :param weight_decay: L2 regularization alpha parameter, default is 0.06
     :param show: Whether or not to show the train/val loss, f1, and auc curves after each fold, default is True
+    :param device: The device the models are trained on
     :param cuda_destination: The GPU that is used by the model
-    :return: A list (size 4) of lists, where the first list contains the auc scores for the training sets, the second
-             list contains the f1 scores for the training sets, the third list contains the auc scores for the
-             validation sets, and the fourth and final list contains the f1 scores for the validation sets
+    :param bf16: Whether to train under bfloat16 autocast
+    :param channels_last: Whether to train in the channels-last memory format
+    :param num_workers: How many folds are trained at the same time, each in its own (forked) process. Only supported
+                        on the CPU
+    :param threads_per_worker: The torch thread budget of each fold process, defaults to splitting the cores evenly
+    :param resume_dir: If given, every fold is checkpointed each epoch to a file in this directory. Rerunning with the
+                       same directory skips the folds that finished and continues the others from their last epoch. The
+                       checkpoints record the network, epochs and hyperparameters (and run_config), and resuming from
+                       checkpoints of a run configured differently raises a ValueError
+    :param run_config: A dictionary of anything else the folds' training depends on, ex. the seed and the folds file
+    :param patience: Early stopping patience (in validations) on the validation AUC, None trains for every epoch
+    :param val_every: How often (in epochs) the validation set is evaluated
+    :param timing_dir: If given, each fold appends its per-epoch phase timings to a JSON lines file in this directory
+                       (see profiling.PhaseTimer)
+    :param profile_dir: If given, a window of each fold's training steps is profiled with torch.profiler and the traces
+                        are written to a subdirectory per fold
+    :param registry: If given, the run_registry.RunRegistry that every fold's epochs and final scores are recorded in
+    :param run_id: The registry's id of this run (see RunRegistry.start_run)
+    :return: A list with a tuple per fold of the fold's model and its scores (auc train, f1 train, auc validation,
+             f1 validation)
     """
-    train_data, train_dataloader = train_data
-    val_data, val_dataloader = val_data
-    auc_train_avg, f1_train_avg, auc_eval_avg, f1_eval_avg = [], [], [], []
-    models = []
-    model = network(cuda_destination)
-    model.cuda(model.cuda_destination)
-    model.load_state_dict(torch.load(
-        "/home/andrewg/PycharmProjects/assignments/predictions/models/{}/{}/{}.pt".format("bval", "CNN",
-                                                                                          1),
-        map_location=device))
-    for k in range(k_low, k_high):
-        print("Fold {}".format(k + 1))
-        # model = network(cuda_destination)
-        # model.cuda(model.cuda_destination)
-        # optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum, weight_decay=weight_decay)
-        # optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
-        optimizer = adabound.AdaBound(model.parameters(), lr=lr, final_lr=final_lr, weight_decay=weight_decay)
-        train_data.change_map_num(k)
-        val_data.change_map_num(k)
-        model, _, auc_train, f1_train, auc_eval, f1_eval = train_model(train_dataloader, val_dataloader, model, epochs,
-                                                                       optimizer, loss_function, softmax=softmax,
-                                                                       show=True)
-        auc_train_avg.append(auc_train)
-        f1_train_avg.append(f1_train)
-        auc_eval_avg.append(auc_eval)
-        f1_eval_avg.append(f1_eval)
-        models.append(model)
+    global _fold_job
+    pretrained_state = load_weights("CNN", 1, "bval")
+    resume_config = dict(run_config or dict(), network=network.__name__, epochs=epochs, lr=lr, final_lr=final_lr,
+                         weight_decay=weight_decay, softmax=softmax, bf16=bf16, patience=patience, val_every=val_every)
+    fold_job = {"network": network, "train_data": train_data, "val_data": val_data, "epochs": epochs,
+                "loss_function": loss_function, "device": device, "lr": lr, "final_lr": final_lr,
+                "weight_decay": weight_decay, "softmax": softmax, "plot": num_workers == 1,
+                "cuda_destination": cuda_destination, "bf16": bf16, "channels_last": channels_last,
+                "pretrained_state": pretrained_state, "resume_dir": resume_dir, "resume_config": resume_config,
+                "patience": patience, "val_every": val_every, "timing_dir": timing_dir,
+                "profile_dir": profile_dir, "registry": registry, "run_id": run_id}
+    for directory in [resume_dir, timing_dir]:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    folds = range(k_low, k_high)
+
+    if num_workers > 1:
+        assert torch.device(device).type == "cpu", "Parallel folds are only supported on the CPU"
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // min(num_workers, len(folds)))
+
+        # The datasets hold SimpleITK filters, which cannot be pickled, so the workers are forked and inherit the job
+        _fold_job = fold_job
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_fold_worker_init, initargs=(threads_per_worker,)) as executor:
+                results = []
+                for state_dict, fold_scores in executor.map(_run_fold_job, folds):
+                    model = network(cuda_destination)
+                    model.load_state_dict(state_dict)
+                    results.append((model.to(device), fold_scores))
+        finally:
+            _fold_job = None
+    else:
+        results = [train_fold(k, **fold_job) for k in folds]
+
+    auc_train_avg, f1_train_avg, auc_eval_avg, f1_eval_avg = [list(fold_scores) for fold_scores in
+                                                              zip(*[fold_scores for _, fold_scores in results])]
 
     scores = [auc_train_avg, f1_train_avg, auc_eval_avg, f1_eval_avg]
     if show:
         print(scores)
 
-    with open("/home/andrewg/PycharmProjects/assignments/predictions/k_fold_statistics/stats.txt", "a") as f:
-        f.write("AUC train average\n")
-        for avg in auc_train_avg:
-            f.write(str(avg) + '\n')
-        f.write("F1 train average\n")
-        for avg in f1_train_avg:
-            f.write(str(avg) + '\n')
-        f.write("AUC eval average\n")
-        for avg in auc_eval_avg:
-            f.write(str(avg) + '\n')
-        f.write("F1 eval average\n")
-        for avg in f1_eval_avg:
-            f.write(str(avg) + '\n')
-    return list(zip(models, scores))
+    if registry:
+        for k, (_, fold_scores) in zip(folds, results):
+            registry.log_result(run_id, k, fold_scores)
+    return results
 
 
 def generate_random_resampled_number():
@@ -730,6 +980,18 @@ def create_kgh_patient_crops(num_crops, crop_dim):
     return bval, adc, t2
 
 
+def kgh_patient_labels(cancer_labels, folders):
+    """
+    Looks up the cancer label of every KGH patient folder
+    :param cancer_labels: The cleaned KGH label dataframe, with anonymized and Total Gleason Xypeguide columns
+    :param folders: The patient folder names (of the form PCAD_XXX_...)
+    :return: An int64 array where the ith element is 1 if patient folders[i] has cancer, else 0
+    """
+    gleason = cancer_labels.set_index("anonymized")["Total Gleason Xypeguide"]
+    patients = ['_'.join(patient_id.split('_')[:2]) for patient_id in folders]
+    return gleason.loc[patients].to_numpy().astype(np.int64)
+
+
 class KGHProstateImages(Dataset):
     def __init__(self, device, modality):
         self.dir = "/home/andrewg/PycharmProjects/assignments/resampled_cropped/kgh/{}".format(modality)
@@ -750,6 +1012,7 @@ class KGHProstateImages(Dataset):
         valid = set(cancer_labels[cancer_labels["Total Gleason Xypeguide"] == 0].index)
         valid.update(cancer_labels[cancer_labels["Total Gleason Xypeguide"] == 1].index)
         self.csv = cancer_labels.loc[valid]
+        self.labels = kgh_patient_labels(self.csv, self.folders)
         self.normalize = sitk.NormalizeImageFilter()
         self.device = device
 
@@ -763,9 +1026,7 @@ class KGHProstateImages(Dataset):
         image_tensor = torch.from_numpy(np.asarray([sitk.GetArrayFromImage(
                        self.normalize.Execute(sitk.ReadImage("{}/{}".format(image_dir, image)))
                        ) for image in self.images])).float().to(self.device)
-        cancer_label = self.csv.loc[self.csv.anonymized == '_'.join(patient_id.split('_')[:2])]
-        cancer_label = int(cancer_label["Total Gleason Xypeguide"])
-        return {"image": image_tensor, "cancer": cancer_label, "index": self.folders[idx]}
+        return {"image": image_tensor, "cancer": int(self.labels[idx]), "index": self.folders[idx]}
 
 
 class KGHProstateImagesV2(Dataset):
@@ -789,6 +1050,7 @@ class KGHProstateImagesV2(Dataset):
         valid = set(cancer_labels[cancer_labels["Total Gleason Xypeguide"] == 0].index)
         valid.update(cancer_labels[cancer_labels["Total Gleason Xypeguide"] == 1].index)
         self.csv = cancer_labels.loc[valid]
+        self.labels = np.repeat(kgh_patient_labels(self.csv, self.folders), self.num_crops)
         self.normalize = sitk.NormalizeImageFilter()
         self.device = device
 
@@ -796,17 +1058,111 @@ class KGHProstateImagesV2(Dataset):
         return self.length
 
     def __getitem__(self, idx):
-        crop_id = idx % 20
-        p_id = idx // 20
+        crop_id = idx % self.num_crops
+        p_id = idx // self.num_crops
         patient_id = self.folders[p_id]
         image_dir = "{}/{}".format(self.dir, patient_id)
 
         image_tensor = torch.from_numpy(np.asarray([sitk.GetArrayFromImage(
                        self.normalize.Execute(sitk.ReadImage("{}/{}".format(image_dir, self.images[crop_id])))
                        )])).float().to(self.device)
-        cancer_label = self.csv.loc[self.csv.anonymized == '_'.join(patient_id.split('_')[:2])]
-        cancer_label = torch.tensor([int(cancer_label["Total Gleason Xypeguide"])])
-        return {"image": image_tensor, "cancer": cancer_label, "index": patient_id}
+        return {"image": image_tensor, "cancer": self.patient_label(p_id), "index": patient_id}
+
+    def __getitems__(self, indices):
+        """
+        Batched version of __getitem__ which the DataLoader uses when fetching a whole batch at once. The indices are
+        grouped by patient so that each patient's directory is only scanned once per batch
+        :param indices: The dataset indices in the batch
+        :return: A list of samples, in the same order as indices
+        """
+        crops_by_patient = {}
+        for position, idx in enumerate(indices):
+            crops_by_patient.setdefault(idx // self.num_crops, []).append((position, idx % self.num_crops))
+
+        samples = [None] * len(indices)
+        for p_id, crops in crops_by_patient.items():
+            image_tensor = self.read_patient_crops(p_id, [crop_id for _, crop_id in crops])
+            cancer_label = self.patient_label(p_id)
+            for (position, _), image in zip(crops, image_tensor):
+                samples[position] = {"image": image.unsqueeze(0), "cancer": cancer_label,
+                                     "index": self.folders[p_id]}
+        return samples
+
+    def patient_label(self, p_id):
+        """
+        Looks up the cancer label of a patient
+        :param p_id: The position of the patient in self.folders
+        :return: A tensor of shape [1] containing 1 if cancer, else 0
+        """
+        return torch.tensor([int(self.labels[p_id * self.num_crops])])
+
+    def read_patient_crops(self, p_id, crop_ids=None):
+        """
+        Reads the crops of one patient using a single scan of the patient's directory
+        :param p_id: The position of the patient in self.folders
+        :param crop_ids: The crops to read (all of them if None)
+        :return: A tensor of shape [len(crop_ids), 3, 32, 32]
+        """
+        if crop_ids is None:
+            crop_ids = range(self.num_crops)
+        wanted = {self.images[crop_id] for crop_id in crop_ids}
+        with os.scandir("{}/{}".format(self.dir, self.folders[p_id])) as entries:
+            paths = {entry.name: entry.path for entry in entries if entry.name in wanted}
+
+        image_tensor = torch.from_numpy(np.asarray([sitk.GetArrayFromImage(
+                       self.normalize.Execute(sitk.ReadImage(paths[self.images[crop_id]])))
+                       for crop_id in crop_ids])).float().to(self.device)
+        return image_tensor
+
+
+class PatientGroupedBatchSampler(Sampler):
+    """
+    Batch sampler for KGHProstateImagesV2 that keeps the crops of a patient together. Each batch holds
+    patients_per_batch patients, and either all of their crops or crops_per_patient randomly chosen crops. Used as the
+    batch_sampler of a DataLoader, each patient directory is then read once per batch (see __getitems__)
+    """
+
+    def __init__(self, num_crops_per_image, patients, patients_per_batch=1, crops_per_patient=None, shuffle=True,
+                 generator=None):
+        """
+        :param num_crops_per_image: The number of crops stored for each patient
+        :param patients: The patient positions (in the dataset's folders) to sample from, or the number of patients
+        :param patients_per_batch: How many patients make up a batch
+        :param crops_per_patient: If given, this many crops are sampled per patient instead of all of them
+        :param shuffle: Whether the order of the patients (and of the sampled crops) is random
+        :param generator: Optional torch.Generator used for the random choices
+        """
+        if isinstance(patients, int):
+            patients = range(patients)
+        assert crops_per_patient is None or 0 < crops_per_patient <= num_crops_per_image
+        self.num_crops = num_crops_per_image
+        self.patients = torch.as_tensor(list(patients), dtype=torch.long)
+        self.patients_per_batch = patients_per_batch
+        self.crops_per_patient = crops_per_patient
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __len__(self):
+        return int(np.ceil(len(self.patients) / self.patients_per_batch))
+
+    def __iter__(self):
+        if self.shuffle:
+            patients = self.patients[torch.randperm(len(self.patients), generator=self.generator)]
+        else:
+            patients = self.patients
+        all_crops = torch.arange(self.num_crops)
+
+        for start in range(0, len(patients), self.patients_per_batch):
+            batch = []
+            for p_id in patients[start: start + self.patients_per_batch].tolist():
+                if self.crops_per_patient is None:
+                    crops = all_crops
+                elif self.shuffle:
+                    crops = torch.randperm(self.num_crops, generator=self.generator)[:self.crops_per_patient]
+                else:
+                    crops = all_crops[:self.crops_per_patient]
+                batch.extend((p_id * self.num_crops + crops).tolist())
+            yield batch
 
 
 def change_requires_grad(model, first_n_layers, new_grad):
@@ -817,16 +1173,100 @@ def change_requires_grad(model, first_n_layers, new_grad):
     :param new_grad: If true, this unfreezes the first 'first_n_layers' layers, else freezes them
     :return: None
     """
-    parameters = model.children()
-    for idx in range(first_n_layers):
-        child = next(parameters, None)
-        if child:
-            child.requires_grad = new_grad
-            if "bias" in dir(child):
-                child.bias.requires_grad = new_grad
-        else:
-            print("There were only {} layers".format(first_n_layers - 1))
-            return
+    layers = model_layers(model)
+    if first_n_layers > len(layers):
+        print("There were only {} layers".format(len(layers)))
+    for layer in layers[:first_n_layers]:
+        for module in layer:
+            for parameter in module.parameters():  # requires_grad on the module itself has no effect
+                parameter.requires_grad = new_grad
+
+
+def model_layers(model):
+    """
+    :param model: A network, with a layers attribute naming the modules of each layer (ex. a convolution and its batch
+                  norm), or else one layer per child module
+    :return: A list with the list of modules of each layer
+    """
+    if hasattr(model, "layers"):
+        return [[getattr(model, name) for name in layer] for layer in model.layers]
+    return [[child] for child in model.children()]
+
+
+class FeatureDataset(Dataset):
+    """
+    Intermediate activations of a network and their cancer labels, in the same dictionary format as the image datasets
+    so they can be used with train_model and ClassBalancedSampler
+    """
+
+    def __init__(self, features, labels):
+        """
+        :param features: A tensor with one feature map per item
+        :param labels: A tensor with one cancer label per item
+        """
+        self.features = features
+        self.labels = labels.numpy().astype(np.int64)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, idx):
+        return {"image": self.features[idx], "cancer": int(self.labels[idx])}
+
+
+def cache_features(model, data_loader, num_layers, device, path=None):
+    """
+    Runs every item of a data loader once through the first num_layers layers of a CNN2, so that the layers after a
+    frozen prefix can be trained on the cached activations (see models.CNN2Head) instead of recomputing the prefix every
+    epoch. The model is put in eval mode, so the prefix's batch norms use their running statistics (batch norms loaded
+    from checkpoints without running statistics normalize over the batches of data_loader, as during training)
+    :param model: The CNN2, whose first num_layers layers are frozen
+    :param data_loader: A loader over the data in a fixed order (no shuffling or class balancing)
+    :param num_layers: The length of the frozen prefix
+    :param device: The device the model is on
+    :param path: If given, the features are saved to this file, and read back (memory-mapped) if it already exists
+    :return: A FeatureDataset of the activations, on the CPU
+    """
+    if path and os.path.isfile(path):
+        cached = torch.load(path, mmap=True)
+        return FeatureDataset(cached["features"], cached["labels"])
+
+    features = []
+    labels = []
+    model.eval()
+    with torch.no_grad():
+        for batch in data_loader:
+            images, class_vector = batch["image"].to(device), batch["cancer"].to(device).unsqueeze(1)
+            image_shape = images.shape
+            if len(image_shape) != 4:
+                images, class_vector = flatten_batch(image_shape, images, class_vector, device)
+            features.append(model.forward_layers(images, 0, num_layers).cpu())
+            labels.append(class_vector.view(-1).long().cpu())
+    features = torch.cat(features)
+    labels = torch.cat(labels)
+    if path:
+        torch.save({"features": features, "labels": labels}, path)
+    return FeatureDataset(features, labels)
+
+
+def compute_cams(model, data_loader, device):
+    """
+    The class activation maps of every item of a data loader, one batched forward pass per batch
+    :param model: A CNN2
+    :param data_loader: A loader over the crops, in the order the maps should be returned
+    :param device: The device the model is on
+    :return: The probabilities [N, 2] and the maps [N, 2, 32, 32] of every crop, on the CPU and in class order
+    """
+    probabilities = []
+    heatmaps = []
+    model.eval()
+    with torch.inference_mode():
+        for batch in data_loader:
+            images = batch["image"].to(device).float()
+            batch_probabilities, batch_heatmaps = model.batch_class_activation_mapping(images)
+            probabilities.append(batch_probabilities.cpu())
+            heatmaps.append(batch_heatmaps.cpu())
+    return torch.cat(probabilities), torch.cat(heatmaps)
 
 
 def bootstrap_auc(y_true, y_pred, ax, nsamples=1000):
@@ -882,42 +1322,27 @@ def nrrd_to_tensor(file):
 
 
 def initialize_CNN2(cnn2_model, modality):
-    cnn_model = torch.load("/home/andrewg/PycharmProjects/assignments/predictions/models/{}/CNN/1.pt".format(modality))
-    layers = ["conv1.weight", "conv1.bias", "conv2.weight", "conv2.bias", "conv3.weight", "conv3.bias", "conv4.weight",
-              "conv4.bias", "conv5.weight", "conv5.bias"]
+    # The CNN's weights and the matching of its parameters to the CNN2's are cached by model_registry. The CNN2 is
+    # trained from here, so batch norms it loaded from a legacy checkpoint get running statistics back
+    cnn2_model.restore_running_statistics()
     state_dict = cnn2_model.state_dict()
-    idx = 0
-    for name, param in state_dict.items():
-        layer = layers[idx]
-        transformed_param = cnn_model[layer]
+    for name, transformed_param in cnn2_initialization(modality).items():
         state_dict[name].copy_(transformed_param)
-        idx = idx + 1
-        if idx == len(layers):
-            return
-
-
-def cam_visualize_one_image(file):
-    seed = 0
-    torch.manual_seed(seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed_all(0)
-
-    cuda_destination = 0
-    ngpu = 1
-    device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
-
-    model = CNN2(cuda_destination=cuda_destination)
-    model.load_state_dict(torch.load(
-        "/home/andrewg/PycharmProjects/assignments/predictions/models/bval/CNN2/46.pt",
-        map_location=device))
-    model.cuda(cuda_destination)
-    model.eval()
 
+
+def cam_visualize_one_image(file, model_version="bval/CNN2/46"):
+    """
+    Shows a crop and its class activation map, read from the store written by cam_store.py (the model is not run)
+    :param file: The path of the crop
+    :param model_version: The store the map is read from
+    :return: None
+    """
+    from cam_store import CamStore
+
+    store = CamStore(model_version)
     im = sitk.ReadImage(file)
     im = sitk.GetArrayFromImage(im).astype(np.float64)
     plt.imshow(im[1], interpolation="bilinear", cmap="gray")
     plt.axis("off")
     plt.show()
-    im = torch.from_numpy(im).cuda()
-    cam = model.class_activation_mapping(im.float())
-    CNN2.visualize(im, cam)
+    CNN2.visualize(torch.from_numpy(im), store.class_activation_mapping(file))
@@ -0,0 +1,214 @@
+import copy
+import math
+import time
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from models import CNN, CNN2
+
+
+def configure_threads(num_threads=None):
+    """
+    Sets the number of threads torch uses for intra-op parallelism on the CPU
+    :param num_threads: The thread budget, if None the current setting is kept
+    :return: The number of threads torch will use
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+
+def prepare_model(model, device, channels_last=False):
+    """
+    Moves a model to a device and optionally converts its 2D convolution weights to channels-last, which lets the
+    oneDNN (CPU) and cuDNN kernels skip layout conversions
+    :param model: The network
+    :param device: The torch.device (or string such as "cpu" or "cuda:0") the model should run on
+    :param channels_last: Whether to use the channels-last memory format
+    :return: The model
+    """
+    model.to(device)
+    if channels_last:
+        for module in model.modules():
+            if isinstance(module, nn.Conv2d):  # The Conv3d and Linear weights have no channels-last layout
+                module.to(memory_format=torch.channels_last)
+    return model
+
+
+def autocast(device, bf16=False):
+    """
+    :param device: The device the forward pass runs on
+    :param bf16: Whether to run eligible operations in bfloat16
+    :return: An autocast context manager for the device (a no-op when bf16 is False)
+    """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=bf16)
+
+
+def estimate_batch_norm_statistics(model, data_loader, device):
+    """
+    Gives batch norms without running statistics (ex. those of a checkpoint saved before they were registered, see
+    models.BatchNormCompatible) the mean and variance of their inputs over a data set, so that in eval mode they no
+    longer depend on the other crops in the batch and can be folded into the convolutions (see fuse_for_inference)
+    :param model: The network, a models.BatchNormCompatible
+    :param data_loader: A loader over representative crops, ex. the training set
+    :param device: The device the model is on
+    :return: None
+    """
+    batch_norms = model.restore_running_statistics()
+    momenta = [batch_norm.momentum for batch_norm in batch_norms]
+    for batch_norm in batch_norms:
+        batch_norm.momentum = None  # A cumulative average over every batch
+    model.train()
+    with torch.no_grad():
+        for batch in data_loader:
+            images = batch["image"].to(device)
+            if images.dim() != 4:
+                images = images.reshape(-1, *images.shape[2:])
+            model(images)
+    model.eval()
+    for batch_norm, momentum in zip(batch_norms, momenta):
+        batch_norm.momentum = momentum
+
+
+def fuse_for_inference(model, example_input=None):
+    """
+    Builds an inference-only copy of a CNN or CNN2. Every batch norm with running statistics is folded into the weights
+    of the convolution before it. If an example batch is given, the copy is also traced and frozen with
+    torch.jit.optimize_for_inference, which fuses the convolutions with their ReLUs (with oneDNN on the CPU)
+    :param model: The network, it is not modified
+    :param example_input: A batch of crops with the shape used at inference, or None to skip tracing
+    :return: The fused model, in eval mode
+    """
+    fused = copy.deepcopy(model).eval()
+    for conv_name, batch_norm_name in fused.conv_batch_norms:
+        batch_norm = getattr(fused, batch_norm_name)
+        if batch_norm.track_running_stats:  # Batch statistics depend on the batch, so they cannot be folded
+            setattr(fused, conv_name, fuse_conv_bn_eval(getattr(fused, conv_name), batch_norm))
+            setattr(fused, batch_norm_name, nn.Identity())
+    if example_input is None:
+        return fused
+    with torch.no_grad():
+        traced = torch.jit.trace(fused, example_input)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+class EarlyStopping:
+    """
+    Tracks a validation metric and signals when it has not improved by more than min_delta for patience consecutive
+    validations. After every step, improved tells whether the latest validation is the new best
+    """
+
+    def __init__(self, patience, min_delta=0.0, mode="max"):
+        """
+        :param patience: How many validations without improvement are tolerated, math.inf to only track the best
+        :param min_delta: The smallest change that counts as an improvement
+        :param mode: "max" if larger values are better (auc, f1), "min" if smaller are (loss)
+        """
+        assert mode in ["max", "min"]
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode
+        self.best = None
+        self.improved = False
+        self.num_bad_validations = 0
+
+    def step(self, value):
+        """
+        :param value: The monitored metric of the latest validation
+        :return: True if training should stop
+        """
+        if self.best is None or math.isnan(self.best):
+            self.improved = not math.isnan(value)
+        elif self.mode == "max":
+            self.improved = value > self.best + self.min_delta
+        else:
+            self.improved = value < self.best - self.min_delta
+
+        if self.improved:
+            self.best = value
+            self.num_bad_validations = 0
+        else:
+            self.num_bad_validations += 1
+        return self.num_bad_validations >= self.patience
+
+    def state_dict(self):
+        return {"best": self.best, "num_bad_validations": self.num_bad_validations}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.num_bad_validations = state["num_bad_validations"]
+
+
+def benchmark_throughput(model, device, batch_size=256, num_batches=20, warmup=3, train=False, bf16=False):
+    """
+    Measures how many synthetic 3x32x32 crops per second a model processes
+    :param model: The network, already on device
+    :param device: The device the model is on
+    :param batch_size: The number of crops in a batch
+    :param num_batches: The number of timed batches
+    :param warmup: The number of untimed batches run first
+    :param train: If True, times forward, backward and an optimizer step, else only the forward pass (no_grad)
+    :param bf16: Whether to use bfloat16 autocast
+    :return: Samples per second
+    """
+    images = torch.randn(batch_size, 3, 32, 32, device=device)
+    if isinstance(model, CNN):
+        targets = torch.randint(0, 2, (batch_size, 1), device=device).float()
+        loss_function = nn.BCELoss()
+    else:
+        targets = torch.randint(0, 2, (batch_size,), device=device)
+        loss_function = nn.CrossEntropyLoss()
+    if train:
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.001)
+    model.train(train)
+
+    def step():
+        if train:
+            optimizer.zero_grad()
+            with autocast(device, bf16):
+                preds = model(images)
+            loss_function(preds.float(), targets).backward()
+            optimizer.step()
+        else:
+            with torch.no_grad(), autocast(device, bf16):
+                model(images)
+
+    for _ in range(warmup):
+        step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return batch_size * num_batches / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    device = torch.device("cpu")
+    num_threads = configure_threads(None)
+    batch_size = 256
+
+    print("Benchmarking on {} with {} threads, batch size {}".format(device, num_threads, batch_size))
+    for network in [CNN, CNN2]:
+        for channels_last in [False, True]:
+            for bf16 in [False, True]:
+                model = prepare_model(network(None), device, channels_last=channels_last)
+                for train in [False, True]:
+                    samples_per_second = benchmark_throughput(model, device, batch_size=batch_size, train=train,
+                                                              bf16=bf16)
+                    print("{} channels_last={} bf16={} {}: {:.0f} samples/s".format(
+                        network.__name__, channels_last, bf16, "train" if train else "inference", samples_per_second))
+
+    for network in [CNN, CNN2]:
+        model = prepare_model(network(None), device).eval()
+        for module in model.modules():  # Give the batch norms non-trivial running statistics
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+        example_input = torch.randn(batch_size, 3, 32, 32, device=device)
+        for name, candidate in [("eager", model), ("folded", fuse_for_inference(model)),
+                                ("folded + traced", fuse_for_inference(model, example_input))]:
+            samples_per_second = benchmark_throughput(candidate, device, batch_size=batch_size)
+            print("{} {} inference (eval): {:.0f} samples/s".format(network.__name__, name, samples_per_second))
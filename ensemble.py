@@ -0,0 +1,94 @@
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call
+
+
+class FoldEnsemble(nn.Module):
+    """
+    The models of every fold of a cross validation evaluated together: their weights are stacked along a new first
+    dimension and torch.func.vmap runs all of them on each batch in one vectorised pass, instead of one pass over the
+    data per fold. Called like a single model it returns the mean of the folds' outputs, predict also gives their
+    spread. vmap turns the convolutions into grouped convolutions, which pay off on a GPU (especially for small
+    batches) but are slower than separate convolutions on the CPU, so there the stacked models are run one after the
+    other
+    """
+
+    def __init__(self, models, vectorized=None):
+        """
+        :param models: The fold models, instances of the same class on the same device. They are not modified
+        :param vectorized: Whether the models are run in one vmap pass, defaults to doing so when they are on a GPU
+        """
+        super(FoldEnsemble, self).__init__()
+        parameters, buffers = stack_module_state(models)
+        # Module attribute names cannot contain dots
+        self.names = {name: name.replace(".", "__") for name in list(parameters) + list(buffers)}
+        for name, parameter in parameters.items():
+            self.register_parameter(self.names[name], nn.Parameter(parameter.detach(), requires_grad=False))
+        for name, buffer in buffers.items():
+            self.register_buffer(self.names[name], buffer)
+        self.num_models = len(models)
+        self.vectorized = vectorized
+        # The architecture without weights of its own (functional_call gives it the stacked ones), kept in a list so it
+        # is not registered as a submodule and moved between devices
+        self._base = [copy.deepcopy(models[0]).to("meta")]
+
+    def forward_members(self, data):
+        """
+        :param data: A batch of inputs, as the fold models take them
+        :return: The outputs of every fold model, [num_models, batch, ...]
+        """
+        base = self._base[0]
+        base.train(self.training)
+        state = {name: getattr(self, attribute) for name, attribute in self.names.items()}
+
+        def member(member_state, member_data):
+            return functional_call(base, member_state, (member_data,))
+
+        vectorized = self.vectorized
+        if vectorized is None:
+            vectorized = data.is_cuda
+        if vectorized:
+            return torch.vmap(member, in_dims=(0, None), randomness="same")(state, data)
+        return torch.stack([member({name: tensor[idx] for name, tensor in state.items()}, data)
+                            for idx in range(self.num_models)])
+
+    def forward(self, data):
+        return self.forward_members(data).mean(0)
+
+    def predict(self, data):
+        """
+        :param data: A batch of inputs
+        :return: The mean and the standard deviation over the folds of the outputs, each [batch, ...]
+        """
+        outputs = self.forward_members(data)
+        return outputs.mean(0), outputs.std(0, unbiased=False)
+
+
+def benchmark_ensemble(models, data, num_runs=10, vectorized=None):
+    """
+    Times the fold models one after the other against the stacked ensemble
+    :param models: The fold models
+    :param data: A batch of inputs
+    :param num_runs: The number of timed passes
+    :param vectorized: See FoldEnsemble
+    :return: A dictionary with the milliseconds per batch of the sequential models and of the ensemble, and the largest
+             absolute difference between their mean outputs
+    """
+    ensemble = FoldEnsemble(models, vectorized=vectorized).eval()
+    for model in models:
+        model.eval()
+    with torch.inference_mode():
+        sequential_mean = torch.stack([model(data) for model in models]).mean(0)
+        difference = float((ensemble(data) - sequential_mean).abs().max())
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            [model(data) for model in models]
+        sequential_seconds = (time.perf_counter() - start) / num_runs
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            ensemble.predict(data)
+        ensemble_seconds = (time.perf_counter() - start) / num_runs
+    return {"sequential_ms": 1000 * sequential_seconds, "ensemble_ms": 1000 * ensemble_seconds,
+            "max_difference": difference}
@@ -0,0 +1,139 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+from engine import fuse_for_inference, estimate_batch_norm_statistics, configure_threads
+from scoring import TorchScriptScorer, OnnxScorer
+from model_registry import load_model
+
+INPUT_SHAPE = (3, 32, 32)  # The crops the networks are exported for, the batch size stays dynamic
+
+
+def _check_exportable(model):
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d) and not module.track_running_stats:
+            raise ValueError("The batch norms have no running statistics (the model was loaded from a checkpoint saved "
+                             "before they were registered), give them some with engine.estimate_batch_norm_statistics")
+
+
+def _example_input():
+    return torch.zeros(2, *INPUT_SHAPE)
+
+
+def export_torchscript(model, path):
+    """
+    Writes a self-contained TorchScript artifact (frozen, with the batch norms folded into the convolutions) that can
+    be loaded with torch.jit.load or scoring.TorchScriptScorer, without models.py
+    :param model: A CNN or CNN2 whose batch norms have running statistics
+    :param path: The .pt file to write
+    :return: The path
+    """
+    _check_exportable(model)
+    fused = fuse_for_inference(model).cpu()
+    with torch.no_grad():
+        traced = torch.jit.trace(fused, _example_input())
+    torch.jit.save(torch.jit.freeze(traced), path)
+    return path
+
+
+def export_onnx(model, path, opset_version=17):
+    """
+    Writes an ONNX artifact (batch norms folded, dynamic batch size) for ONNX Runtime, see scoring.OnnxScorer
+    :param model: A CNN or CNN2 whose batch norms have running statistics
+    :param path: The .onnx file to write
+    :param opset_version: The ONNX opset
+    :return: The path
+    """
+    _check_exportable(model)
+    fused = fuse_for_inference(model).cpu()
+    torch.onnx.export(fused, (_example_input(),), path, input_names=["crops"], output_names=["outputs"],
+                      dynamic_axes={"crops": {0: "batch"}, "outputs": {0: "batch"}}, opset_version=opset_version,
+                      dynamo=False)
+    return path
+
+
+def check_parity(model, torchscript_path=None, onnx_path=None, crops=None, atol=1e-4):
+    """
+    Checks that the exported artifacts give the same outputs as the eager model
+    :param model: The model that was exported
+    :param torchscript_path: The TorchScript artifact, if one was exported
+    :param onnx_path: The ONNX artifact, if one was exported
+    :param crops: A [batch, 3, 32, 32] tensor to compare on, defaults to 64 random crops
+    :param atol: The largest absolute difference allowed
+    :return: A dictionary with the largest absolute difference of each artifact
+    """
+    if crops is None:
+        crops = torch.randn(64, *INPUT_SHAPE, generator=torch.Generator().manual_seed(0))
+    model.eval()
+    with torch.no_grad():
+        expected = model(crops.to(next(model.parameters()).device)).cpu().numpy()
+
+    differences = dict()
+    if torchscript_path:
+        differences["torchscript"] = float(np.abs(TorchScriptScorer(torchscript_path)(crops) - expected).max())
+    if onnx_path:
+        differences["onnx"] = float(np.abs(OnnxScorer(onnx_path)(crops.numpy()) - expected).max())
+    for runtime, difference in differences.items():
+        assert difference <= atol, "{} outputs differ from eager by {}".format(runtime, difference)
+    return differences
+
+
+def benchmark_latency(model, torchscript_path, onnx_path, batch_sizes=(1, 8, 32, 128, 512), num_runs=20, warmup=3):
+    """
+    Times the eager model, the TorchScript artifact and the ONNX artifact (on ONNX Runtime) on the CPU
+    :param model: The eager model, on the CPU
+    :param batch_sizes: The batch sizes to time
+    :param num_runs: The number of timed batches per runtime and batch size
+    :param warmup: The number of untimed batches run first
+    :return: A dataframe with the mean milliseconds per batch and the samples per second of every runtime and batch size
+    """
+    model.eval()
+
+    def eager(crops):
+        with torch.inference_mode():
+            return model(torch.as_tensor(crops)).numpy()
+
+    runtimes = {"eager": eager, "torchscript": TorchScriptScorer(torchscript_path),
+                "onnxruntime": OnnxScorer(onnx_path)}
+    rows = []
+    for batch_size in batch_sizes:
+        crops = np.random.default_rng(0).standard_normal((batch_size, *INPUT_SHAPE), dtype=np.float32)
+        for name, runtime in runtimes.items():
+            for _ in range(warmup):
+                runtime(crops)
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                runtime(crops)
+            seconds = (time.perf_counter() - start) / num_runs
+            rows.append({"runtime": name, "batch_size": batch_size, "ms_per_batch": 1000 * seconds,
+                         "samples_per_second": batch_size / seconds})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    from data_helpers import ProstateImages
+
+    modality = "bval"
+    model_type = "CNN2"  # "CNN" or "CNN2"
+    model_number = 46
+    num_calibration_crops = 2000  # Training crops used to give old checkpoints batch norm running statistics
+    num_threads = None
+    configure_threads(num_threads)
+
+    export_dir = "/home/andrewg/PycharmProjects/assignments/predictions/exported/{}/{}".format(modality, model_type)
+    os.makedirs(export_dir, exist_ok=True)
+
+    model = load_model(model_type, model_number, modality)
+    if not model.batch_norm1.track_running_stats:
+        p_images = ProstateImages(modality=modality, train=True, device="cpu", normalize_strategy=1)
+        indices = np.random.default_rng(0).permutation(len(p_images))[:num_calibration_crops]
+        estimate_batch_norm_statistics(model, DataLoader(Subset(p_images, indices), batch_size=100), "cpu")
+    model.eval()
+
+    torchscript_path = export_torchscript(model, "{}/{}.pt".format(export_dir, model_number))
+    onnx_path = export_onnx(model, "{}/{}.onnx".format(export_dir, model_number))
+    print("Largest difference from eager: {}".format(check_parity(model, torchscript_path, onnx_path)))
+    print(benchmark_latency(model, torchscript_path, onnx_path).to_string(index=False))
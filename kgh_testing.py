@@ -1,7 +1,8 @@
 import torch.utils.data
-from models import CNN, CNN2
+from models import CNN2
 from sklearn.metrics import auc, roc_curve
 from data_helpers import KGHProstateImages, bootstrap_auc
+from model_registry import load_model
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -15,12 +16,7 @@ if __name__ == "__main__":
     ngpu = 1
     device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
 
-    model = CNN2(cuda_destination=cuda_destination)
-    model.load_state_dict(torch.load(
-        "/home/andrewg/PycharmProjects/assignments/predictions/models/bval/CNN2/46.pt",
-        map_location=device))
-    model.cuda(cuda_destination)
-    model.eval()
+    model = load_model("CNN2", 46, "bval", device=device, cuda_destination=cuda_destination)
     data = KGHProstateImages(device, modality="t2")
 
     original_images = data[0]["image"][0].unsqueeze(0)
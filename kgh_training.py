@@ -1,10 +1,16 @@
 import torch
 from torch.utils.data import Dataset, DataLoader
 import torch.nn as nn
-from models import CNN, CNN2
-from data_helpers import train_model, KGHProstateImages, change_requires_grad, flatten_batch
+from models import CNN, CNN2, CNN2Head
+from data_helpers import train_model, KGHProstateImages, ClassBalancedSampler, change_requires_grad, flatten_batch, \
+    cache_features, model_layers
 from adabound import AdaBound
+from sweep import grid, successive_halving
+from model_registry import load_weights
+from engine import estimate_batch_norm_statistics
 import random
+import os
+import time
 
 
 def train_test_split(data, num_crops_per_image, percent_cancer=0.5, percent_non_cancer=0.5):
@@ -38,34 +44,54 @@ def train_test_split(data, num_crops_per_image, percent_cancer=0.5, percent_non_
     return training_data, testing_data
 
 
-def kgh_experiment(cnn_type, loss_function, hyperparameters, starting_layer=8, ending_layer=None,
-                   optimizer="adabound", re_init=True):
-
-    assert optimizer in ["adabound", "sgd"]
-    num_layers, lr, final_lr, weight_decay, num_epochs = hyperparameters
-
-    for num_layers_to_freeze in range(starting_layer, ending_layer):
-        print("{} layers frozen".format(num_layers_to_freeze))
-        model = cnn_type(cuda_destination)
-        model.cuda(cuda_destination)
-        model.load_state_dict(torch.load(
-            "/home/andrewg/PycharmProjects/assignments/predictions/models/{}/{}/{}.pt" .format("bval", "CNN2",
-                                                                                               46),
-            map_location=device))
-
-        if re_init:
-            for child_num in range(-1, -1 * (num_layers - num_layers_to_freeze + 1), -1):
-                print("Reinitialized layer {}".format(num_layers + child_num + 1))
-                nn.init.kaiming_normal_(list(model.children())[child_num].weight)
-
-            change_requires_grad(model, num_layers_to_freeze, False)
-        if optimizer == "adabound":
-            optimizer = AdaBound(model.parameters(), lr=lr, final_lr=final_lr, weight_decay=weight_decay)
-        elif optimizer == "sgd":
-            optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=weight_decay)
-
-        model, conf_matrix, _, _, best_auc, _ = train_model(train_loader, test_loader, model, num_epochs, optimizer,
-                                                            loss_function, softmax=softmax, show=True)
+def kgh_trial(trial_id, config, num_epochs):
+    """
+    Fine-tunes the pretrained network on the KGH data with one hyperparameter configuration of the sweep. The trial's
+    training state is checkpointed, so when successive halving gives it a larger budget it continues from where its
+    previous rung stopped
+    :param trial_id: The index of the configuration in the sweep
+    :param config: A dictionary with lr, final_lr, weight_decay and num_layers_to_freeze
+    :param num_epochs: The total number of epochs the trial should have been trained for after this call
+    :return: The best validation AUC so far
+    """
+    num_layers_to_freeze = config["num_layers_to_freeze"]
+    print("Trial {}: {}, {} epochs".format(trial_id, config, num_epochs))
+    model = cnn_type(cuda_destination)
+    model.load_state_dict(pretrained_state)
+    model.to(device)
+
+    if re_init:
+        for layer in model_layers(model)[num_layers_to_freeze:num_layers]:
+            for module in layer:
+                if isinstance(module, (nn.Conv2d, nn.Conv3d, nn.Linear)):
+                    nn.init.kaiming_normal_(module.weight)
+    change_requires_grad(model, num_layers_to_freeze, False)
+
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    if optimizer_type == "adabound":
+        optimizer = AdaBound(parameters, lr=config["lr"], final_lr=config["final_lr"],
+                             weight_decay=config["weight_decay"])
+    else:
+        optimizer = torch.optim.SGD(parameters, lr=config["lr"], momentum=0.9, weight_decay=config["weight_decay"])
+
+    if num_layers_to_freeze in feature_caches:
+        # Only the head is trained, on the activations of the frozen layers computed once before the sweep
+        train_features, test_features = feature_caches[num_layers_to_freeze]
+        trial_train_loader = DataLoader(train_features, batch_size=train_loader.batch_size,
+                                        sampler=ClassBalancedSampler(train_features, num_samples=samples_per_epoch))
+        trial_test_loader = DataLoader(test_features, batch_size=test_loader.batch_size)
+        trained_model = CNN2Head(model, num_layers_to_freeze)
+    else:
+        trial_train_loader, trial_test_loader, trained_model = train_loader, test_loader, model
+
+    resume_path = "{}/lr{}_final{}_wd{}_frozen{}{}.pt".format(checkpoint_dir, config["lr"], config["final_lr"],
+                                                              config["weight_decay"], num_layers_to_freeze,
+                                                              "_cached" if trained_model is not model else "")
+    _, _, _, _, best_auc, _ = train_model(trial_train_loader, trial_test_loader, trained_model, num_epochs, optimizer,
+                                          loss_function, softmax=softmax, show=False, device=device,
+                                          resume_path=resume_path, patience=patience, val_every=val_every,
+                                          initialize=False)
+    return best_auc
 
 
 if __name__ == "__main__":
@@ -81,6 +107,7 @@ if __name__ == "__main__":
 
     # Prepare the data
     modalities = ["adc"]  # ["t2", "adc", "bval"]
+    samples_per_epoch = None  # None means one pass worth of samples over the training split
 
     for modality in modalities:
         print("Beginning training with modality {}".format(modality))
@@ -90,7 +117,8 @@ if __name__ == "__main__":
         num_train = int(0.8 * len(data))
         num_val = len(data) - num_train
         training_data, testing_data = torch.utils.data.random_split(data, (num_train, num_val))
-        train_loader = DataLoader(training_data, batch_size=5, shuffle=True)
+        train_loader = DataLoader(training_data, batch_size=5,
+                                  sampler=ClassBalancedSampler(training_data, num_samples=samples_per_epoch))
         test_loader = DataLoader(testing_data, batch_size=5)
 
         num_cancer_here = 0
@@ -98,37 +126,71 @@ if __name__ == "__main__":
             num_cancer_here += training_data[i]["cancer"]
         print(num_cancer_here, len(training_data), len(training_data) - num_cancer_here)
         print(len(testing_data))
-        exit()
 
         softmax = True
 
         if softmax:
             cnn_type = CNN2
             best_model = 46
-            loss_function = nn.CrossEntropyLoss().cuda(cuda_destination)
+            loss_function = nn.CrossEntropyLoss()
         else:
             cnn_type = CNN
             best_model = 1
-            loss_function = nn.BCELoss().cuda(cuda_destination)
+            loss_function = nn.BCELoss()
 
-        num_layers = 9
-        num_epochs = 500
-
-        num_options = 1
-        possible_lr = (0.000001 + 0.0000005 * i for i in range(num_options, num_options + 1))
-        for lr in possible_lr:
-            final_lr = 100 * lr
-            possible_weight_decay = (0.0001 + 0.00005 * i for i in range(num_options, num_options + 1))
-            for weight_decay in possible_weight_decay:
-                hyperparameters = [
-                    num_layers,
-                    lr,
-                    final_lr,
-                    weight_decay,
-                    num_epochs
-                ]
-
-                print("Learning rate: {}, Weight decay: {}".format(lr, weight_decay))
-                kgh_experiment(cnn_type, loss_function, hyperparameters, starting_layer=7,
-                               ending_layer=8, re_init=False)
+        # Loaded once, the sweep's worker processes share it
+        pretrained_state = load_weights(cnn_type.__name__, best_model, "bval")
 
+        num_layers = 9
+        re_init = False
+        optimizer_type = "adabound"  # "adabound" or "sgd"
+        patience = 25  # The best AUC usually comes long before the last epoch
+        val_every = 5
+        # The trials of a sweep are checkpointed under its id, so that a new sweep never resumes an older one's trials.
+        # Set it to the id of an interrupted sweep to continue that sweep
+        sweep_id = time.strftime("%Y%m%d-%H%M%S")
+        checkpoint_dir = "/home/andrewg/PycharmProjects/assignments/predictions/checkpoints/kgh/{}/{}".format(modality,
+                                                                                                          sweep_id)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # Successive halving: every configuration gets min_epochs, the best third of them three times as many, and so
+        # on up to max_epochs
+        min_epochs = 20
+        max_epochs = 500
+        reduction_factor = 3
+        num_sweep_workers = 1
+        threads_per_worker = None
+
+        possible_lr = [0.000001 + 0.0000005 * i for i in range(1, 4)]
+        search_space = {"lr": possible_lr,
+                        "weight_decay": [0.0001 + 0.00005 * i for i in range(1, 4)],
+                        "num_layers_to_freeze": [6, 7, 8]}
+        configs = grid(search_space)
+        for config in configs:
+            config["final_lr"] = 100 * config["lr"]
+
+        # With cache_frozen_features, every frozen prefix of the search space is run over the data once, and the trials
+        # only train the layers after it
+        cache_frozen_features = softmax
+        feature_caches = dict()
+        pretrained_model = cnn_type(cuda_destination)
+        pretrained_model.load_state_dict(pretrained_state)
+        pretrained_model.to(device)
+        if not pretrained_model.batch_norm1.track_running_stats:
+            # A checkpoint saved before the batch norms were registered: their running statistics are estimated on the
+            # KGH training crops, so that neither the trials nor the cached features depend on the batch
+            estimate_batch_norm_statistics(pretrained_model, DataLoader(training_data, batch_size=100), device)
+            pretrained_state = {name: tensor.cpu() for name, tensor in pretrained_model.state_dict().items()}
+        if cache_frozen_features:
+            feature_model = pretrained_model
+            ordered_train_loader = DataLoader(training_data, batch_size=train_loader.batch_size)
+            for num_layers_to_freeze in search_space["num_layers_to_freeze"]:
+                feature_caches[num_layers_to_freeze] = (
+                    cache_features(feature_model, ordered_train_loader, num_layers_to_freeze, device),
+                    cache_features(feature_model, test_loader, num_layers_to_freeze, device))
+
+        results = successive_halving(configs, kgh_trial, min_epochs, max_epochs, reduction_factor=reduction_factor,
+                                     num_workers=num_sweep_workers, threads_per_worker=threads_per_worker,
+                                     device=device)
+        results.to_csv("{}/sweep.csv".format(checkpoint_dir), index=False)
+        print(results.to_string(index=False))
@@ -0,0 +1,79 @@
+import os
+import time
+import numpy as np
+import SimpleITK as sitk
+import torch
+from torch.utils.data import DataLoader, Subset
+from models import FullyConvolutionalCNN2
+from model_registry import load_model
+from engine import estimate_batch_norm_statistics, configure_threads
+
+CROP_SIZE = (32, 32, 3)  # The (x, y, z) size of the crops CNN2 was trained on
+
+
+def probability_map(model, volume, device, code=1):
+    """
+    The probability of a class at every window of a volume, from one fully convolutional pass of a CNN2 (see
+    models.FullyConvolutionalCNN2) instead of a forward pass per crop. The volume is normalized as a whole, while the
+    crops were normalized one by one, so the probabilities differ slightly from those of crops cut out at the same
+    places
+    :param model: The CNN2, its batch norms need running statistics (see engine.estimate_batch_norm_statistics)
+    :param volume: A SimpleITK image resampled like the crops, ex. resample_image(image, (2, 2, 3))
+    :param device: The device the model is on
+    :param code: The class, 1 for cancer
+    :return: A SimpleITK image of the probabilities registered to the volume. Every voxel lies at the centre of its
+             window (where crop_from_center would centre the crop), the spacing is 4 times the volume's in x and y
+    """
+    if not model.batch_norm1.track_running_stats:
+        raise ValueError("The batch norms have no running statistics (the model was loaded from a checkpoint saved "
+                         "before they were registered), give them some with engine.estimate_batch_norm_statistics")
+    size = volume.GetSize()
+    if any(length < crop_length for length, crop_length in zip(size, CROP_SIZE)):
+        raise ValueError("The volume {} is smaller than a crop {}".format(size, CROP_SIZE))
+
+    volume_array = sitk.GetArrayFromImage(sitk.NormalizeImageFilter().Execute(volume)).astype(np.float32)
+    fully_convolutional = FullyConvolutionalCNN2(model).eval()
+    with torch.inference_mode():
+        probabilities = fully_convolutional(torch.from_numpy(volume_array).unsqueeze(0).to(device))[0, :, code]
+
+    stride = FullyConvolutionalCNN2.stride
+    spacing = volume.GetSpacing()
+    probability_image = sitk.GetImageFromArray(probabilities.cpu().numpy().astype(np.float64))
+    probability_image.SetSpacing((spacing[0] * stride, spacing[1] * stride, spacing[2]))
+    probability_image.SetDirection(volume.GetDirection())
+    probability_image.SetOrigin(volume.TransformIndexToPhysicalPoint([length // 2 for length in CROP_SIZE]))
+    return probability_image
+
+
+if __name__ == "__main__":
+    from data_helpers import ProstateImages
+
+    modality = "bval"
+    model_number = 46
+    patient = "ProstateX-0000"
+    num_calibration_crops = 2000  # Training crops used to give old checkpoints batch norm running statistics
+    num_threads = None
+    configure_threads(num_threads)
+
+    cuda_destination = 0
+    ngpu = 1
+    device = torch.device("cuda:{}".format(cuda_destination) if (torch.cuda.is_available() and ngpu > 0) else "cpu")
+
+    model = load_model("CNN2", model_number, modality, device=device, cuda_destination=cuda_destination)
+    if not model.batch_norm1.track_running_stats:
+        p_images = ProstateImages(modality=modality, train=True, device=device, normalize_strategy=1)
+        indices = np.random.default_rng(0).permutation(len(p_images))[:num_calibration_crops]
+        estimate_batch_norm_statistics(model, DataLoader(Subset(p_images, indices), batch_size=100), device)
+
+    # Resampled to (2, 2, 3) by A2.py, as the crops were
+    volume = sitk.ReadImage("/home/andrewg/PycharmProjects/assignments/resampled/{}/{}.nrrd".format(modality, patient))
+    start = time.perf_counter()
+    probabilities = probability_map(model, volume, device)
+    seconds = time.perf_counter() - start
+
+    map_dir = "/home/andrewg/PycharmProjects/assignments/predictions/probability_maps/{}".format(modality)
+    os.makedirs(map_dir, exist_ok=True)
+    sitk.WriteImage(probabilities, "{}/{}.nrrd".format(map_dir, patient))
+    num_windows = int(np.prod(probabilities.GetSize()))
+    print("{} windows scored in {:.2f} seconds ({:.0f} windows per second), the most suspicious has probability {:.3f}"
+          .format(num_windows, seconds, num_windows / seconds, sitk.GetArrayViewFromImage(probabilities).max()))
@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+
+
+class BinnedAUC:
+    """
+    Streaming ROC-AUC over predicted probabilities. Scores are counted into fixed-width histograms, one for each class,
+    and the AUC is read off the histograms in O(num_bins). Pairs of scores that fall in the same bin count as ties, so
+    the error is at most the fraction of (positive, negative) pairs sharing a bin. Histograms from different batches,
+    epochs or workers can be combined with merge
+    """
+
+    def __init__(self, device, num_bins=1000):
+        """
+        :param device: The device the scores live on
+        :param num_bins: The number of equal-width bins over [0, 1]
+        """
+        self.num_bins = num_bins
+        self.histograms = torch.zeros(2, num_bins, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.histograms.zero_()
+
+    def update(self, scores, targets):
+        """
+        :param scores: The predicted probabilities of the positive class
+        :param targets: The labels (0 or 1) of the scores
+        :return: None
+        """
+        bins = torch.clamp((scores.detach().reshape(-1) * self.num_bins).long(), 0, self.num_bins - 1)
+        bins = bins + self.num_bins * targets.detach().reshape(-1).long()
+        # index_add_ rather than bincount, which would synchronize with a GPU to read the largest bin
+        self.histograms.view(-1).index_add_(0, bins, torch.ones_like(bins, dtype=self.histograms.dtype))
+
+    def merge(self, other):
+        """
+        Adds the counts of another BinnedAUC (with the same number of bins) to this one
+        :param other: The BinnedAUC to merge in
+        :return: self
+        """
+        assert other.num_bins == self.num_bins
+        self.histograms += other.histograms.to(self.histograms.device)
+        return self
+
+    def compute(self):
+        """
+        :return: The area under the ROC curve, or nan if only one class has been seen
+        """
+        negatives, positives = self.histograms.cpu().numpy().astype(np.float64)
+        num_pairs = positives.sum() * negatives.sum()
+        if num_pairs == 0:
+            return float("nan")
+        negatives_below = np.cumsum(negatives) - negatives
+        return float((positives * negatives_below).sum() + 0.5 * (positives * negatives).sum()) / num_pairs
+
+
+class BinaryMetrics:
+    """
+    Streaming metrics for a binary classifier. The confusion counts, the summed loss and a histogram of the predicted
+    probabilities of the positive class are accumulated in preallocated tensors on the model's device, so nothing is
+    copied to the host until compute is called at the end of an epoch
+    """
+
+    def __init__(self, device, num_bins=1000):
+        """
+        :param device: The device the model's outputs live on
+        :param num_bins: The number of histogram bins used for the AUC (see BinnedAUC)
+        """
+        self.device = device
+        self.counts = torch.zeros(4, dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), device=device)
+        self.roc = BinnedAUC(device, num_bins=num_bins)
+        self.num_batches = 0
+
+    def reset(self):
+        """
+        Clears the accumulated values, keeping the allocated buffers
+        :return: None
+        """
+        self.counts.zero_()
+        self.loss_sum.zero_()
+        self.roc.reset()
+        self.num_batches = 0
+
+    def update(self, preds, targets, loss=None):
+        """
+        Adds a batch to the running totals
+        :param preds: The model's outputs, either [batch, 2] softmax probabilities or [batch, 1] sigmoid probabilities
+        :param targets: The labels of the batch (0 for non-cancer, 1 for cancer)
+        :param loss: The batch's loss, if it should be averaged
+        :return: None
+        """
+        preds = preds.detach()
+        if preds.dim() == 2 and preds.shape[1] == 2:
+            scores = preds[:, 1]
+            hard_preds = preds.argmax(1)
+        else:
+            scores = preds.reshape(-1)
+            hard_preds = torch.round(scores).long()
+        targets = targets.detach().reshape(-1).long()
+
+        # Index 2 * actual + predicted is TN, FP, FN, TP for 0, 1, 2, 3. Unlike bincount, index_add_ does not read the
+        # largest index on the host, so a batch is counted without synchronizing with a GPU
+        self.counts.index_add_(0, 2 * targets + hard_preds, torch.ones_like(targets))
+
+        self.roc.update(scores, targets)
+
+        if loss is not None:
+            self.loss_sum += loss.detach()
+            self.num_batches += 1
+
+    def merge(self, other):
+        """
+        Adds the totals of another BinaryMetrics (ex. from another worker) to this one
+        :param other: The BinaryMetrics to merge in
+        :return: self
+        """
+        self.counts += other.counts.to(self.device)
+        self.loss_sum += other.loss_sum.to(self.device)
+        self.roc.merge(other.roc)
+        self.num_batches += other.num_batches
+        return self
+
+    def compute(self):
+        """
+        Copies the confusion counts to the host (once) and derives the epoch's statistics from them
+        :return: A dictionary with the average loss, f1, the AUC of the probabilities, the AUC of the hard predictions
+                 and the 2x2 confusion matrix (rows are the actual class, columns the predicted class, as in sklearn)
+        """
+        counts = self.counts.cpu().numpy()
+        tn, fp, fn, tp = counts.astype(np.float64)
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0.0
+
+        # The ROC curve of hard predictions has a single point (fpr, tpr) between (0, 0) and (1, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tpr = np.divide(tp, tp + fn)
+            fpr = np.divide(fp, fp + tn)
+        hard_auc = (1 + tpr - fpr) / 2
+
+        loss = float(self.loss_sum) / self.num_batches if self.num_batches else float("nan")
+        return {"loss": loss, "f1": f1, "auc": self.roc.compute(), "hard_auc": hard_auc,
+                "confusion_matrix": counts.reshape(2, 2)}
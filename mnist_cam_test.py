@@ -26,17 +26,17 @@ mnist_trainset = torchvision.datasets.MNIST(root='./data', train=True, download=
 
 mnist_loader = DataLoader(mnist_trainset, batch_size=200)
 mnist_cnn = MNIST_CNN(0)
-mnist_cnn.cuda(0)
+mnist_cnn.to(device)
 
 training_data, testing_data = torch.utils.data.random_split(mnist_trainset, (int(0.8 * len(mnist_trainset)),
                                                                              int(0.2 * len(mnist_trainset))))
 train_loader = DataLoader(training_data, batch_size=200)
 test_loader = DataLoader(testing_data, batch_size=200)
 optimizer = AdaBound(mnist_cnn.parameters(), lr=0.0001, final_lr=0.001, weight_decay=0.05)
-loss_function = nn.CrossEntropyLoss().cuda(cuda_destination)
+loss_function = nn.CrossEntropyLoss()
 train_model(mnist_loader, test_loader, mnist_cnn, 40, optimizer,
-            loss_function, softmax=True, show=True)
-image = next(iter(train_loader))[0].cuda(0)
+            loss_function, softmax=True, show=True, device=device)
+image = next(iter(train_loader))[0].to(device)
 print(image.shape)
 for i in range(10):
     print(MNIST_CNN.visualize(image[i], mnist_cnn.class_activation_mapping(image[i])))
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os
+import torch
+from models import CNN, CNN2
+
+MODEL_DIR = "/home/andrewg/PycharmProjects/assignments/predictions/models"
+NETWORKS = {"CNN": CNN, "CNN2": CNN2}
+
+_state_dicts = dict()  # The state dicts loaded by this process, by path and modification time
+_cnn2_initializations = dict()  # The CNN weights initialize_CNN2 copies, by modality
+
+
+def model_path(name, version, modality=None):
+    """
+    :param name: The network, "CNN" or "CNN2"
+    :param version: The number of the saved model, ex. 46
+    :param modality: The modality the model was trained on. None gives the older checkpoints saved directly in the
+                     models directory (ex. models/30.pt)
+    :return: The path of the checkpoint
+    """
+    if modality is None:
+        return "{}/{}.pt".format(MODEL_DIR, version)
+    return "{}/{}/{}/{}.pt".format(MODEL_DIR, modality, name, version)
+
+
+def load_weights(name, version, modality=None):
+    """
+    Loads a saved model's weights once per process. The file is memory-mapped when its format allows it (checkpoints
+    saved with the legacy, non zip, format are read in full), so only the tensors that are used are read from disk.
+    Rewriting the file invalidates the cached copy. The returned tensors are shared by every caller, copy them into a
+    model (load_state_dict does) rather than modifying them
+    :param name: The network, "CNN" or "CNN2"
+    :param version: The number of the saved model
+    :param modality: See model_path
+    :return: The state dict, on the CPU
+    """
+    path = model_path(name, version, modality)
+    key = (path, os.path.getmtime(path))
+    if key not in _state_dicts:
+        try:
+            state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except RuntimeError:
+            state_dict = torch.load(path, map_location="cpu", weights_only=True)
+        _state_dicts[key] = state_dict
+    return _state_dicts[key]
+
+
+def load_model(name, version, modality=None, device="cpu", cuda_destination=None):
+    """
+    :param name: The network, "CNN" or "CNN2"
+    :param version: The number of the saved model
+    :param modality: See model_path
+    :param device: The device the model is moved to
+    :param cuda_destination: Passed to the network's constructor
+    :return: A new model with the saved weights, in eval mode
+    """
+    model = NETWORKS[name](cuda_destination)
+    model.load_state_dict(load_weights(name, version, modality))
+    return model.to(device).eval()
+
+
+def cnn2_initialization(modality, version=1):
+    """
+    The weights data_helpers.initialize_CNN2 gives a CNN2: the convolutions of a saved CNN, which has the same
+    convolution stack. The matching of the parameters is done once per modality
+    :param modality: The modality the CNN was trained on
+    :param version: The number of the saved CNN
+    :return: A dictionary from the names of the CNN2's convolution parameters to the CNN's tensors
+    """
+    if (modality, version) not in _cnn2_initializations:
+        cnn_state = load_weights("CNN", version, modality)
+        layers = ["conv1.weight", "conv1.bias", "conv2.weight", "conv2.bias", "conv3.weight", "conv3.bias",
+                  "conv4.weight", "conv4.bias", "conv5.weight", "conv5.bias"]
+        # The CNN2's parameters are matched by position, its first ones are the convolutions in the same order
+        cnn2_names = list(CNN2(None).state_dict())[:len(layers)]
+        _cnn2_initializations[(modality, version)] = {cnn2_name: cnn_state[layer]
+                                                      for cnn2_name, layer in zip(cnn2_names, layers)}
+    return _cnn2_initializations[(modality, version)]
@@ -20,7 +20,67 @@ def image_visualize(data, feature_maps):
     plt.show()
 
 
-class CNN(nn.Module):
+def class_activation_maps(dense, activation_maps, size):
+    """
+    Weights the activation maps of a global average pooling network by every class's dense weights, for a whole batch
+    at once
+    :param dense: The nn.Linear after the pooling
+    :param activation_maps: The [batch, channels, height, width] maps before the pooling
+    :param size: The (height, width) the maps are upsampled to
+    :return: A [batch, classes, height, width] tensor
+    """
+    class_activations = torch.einsum("kc,bchw->bkhw", dense.weight, activation_maps)
+    class_activations = class_activations + dense.bias.view(1, -1, 1, 1)
+    return nn.functional.interpolate(class_activations, size=size, mode="bilinear", align_corners=False)
+
+
+class BatchNormCompatible(nn.Module):
+    """
+    Base class of the networks with registered batch norms. Checkpoints saved before the batch norms were registered
+    (ex. models/1.pt) have no entries for them. The old forward passes built a new BatchNorm2d on every call, which
+    always normalized a batch with its own statistics and had a unit scale and zero shift, so loading such a checkpoint
+    sets the batch norms up to do exactly that (no running statistics, weight 1 and bias 0). That is only kept for
+    inference, a model trained further from such a checkpoint first gets running statistics back (see
+    restore_running_statistics)
+    """
+
+    def load_state_dict(self, state_dict, strict=True):
+        batch_norms = [(name, module) for name, module in self.named_modules() if isinstance(module, nn.BatchNorm2d)]
+        state_dict = dict(state_dict)
+        for name, batch_norm in batch_norms:
+            if "{}.running_mean".format(name) not in state_dict and batch_norm.track_running_stats:
+                batch_norm.track_running_stats = False
+                batch_norm.running_mean = None
+                batch_norm.running_var = None
+                batch_norm.num_batches_tracked = None
+            state_dict.setdefault("{}.weight".format(name), torch.ones_like(batch_norm.weight))
+            state_dict.setdefault("{}.bias".format(name), torch.zeros_like(batch_norm.bias))
+        return super(BatchNormCompatible, self).load_state_dict(state_dict, strict=strict)
+
+    def restore_running_statistics(self):
+        """
+        Gives the batch norms a legacy checkpoint left without running statistics fresh ones (zero mean and unit
+        variance), which training then updates, so that in eval mode they no longer normalize over the batch
+        :return: The batch norms that were given running statistics
+        """
+        restored = []
+        for batch_norm in self.modules():
+            if isinstance(batch_norm, nn.BatchNorm2d) and not batch_norm.track_running_stats:
+                device = batch_norm.weight.device
+                batch_norm.track_running_stats = True
+                batch_norm.register_buffer("running_mean", torch.zeros(batch_norm.num_features, device=device))
+                batch_norm.register_buffer("running_var", torch.ones(batch_norm.num_features, device=device))
+                batch_norm.register_buffer("num_batches_tracked", torch.tensor(0, dtype=torch.long, device=device))
+                restored.append(batch_norm)
+        return restored
+
+
+class CNN(BatchNormCompatible):
+
+    # The modules of each layer (see data_helpers.change_requires_grad), and the convolutions followed by batch norms
+    layers = [["conv1"], ["conv2", "batch_norm1"], ["max_pool1"], ["conv3", "batch_norm2"], ["conv4"], ["max_pool2"],
+              ["conv5"], ["dense1"], ["dense2"]]
+    conv_batch_norms = [("conv2", "batch_norm1"), ("conv3", "batch_norm2")]
 
     def __init__(self, cuda_destination):
         super(CNN, self).__init__()
@@ -33,6 +93,9 @@ class CNN(nn.Module):
         self.conv5 = nn.Conv2d(in_channels=64, out_channels=64, kernel_size=(2, 2), stride=1)
         self.dense1 = nn.Linear(in_features=1024, out_features=256)
         self.dense2 = nn.Linear(in_features=256, out_features=1)
+        # Registered last so the order of the other parameters (and of existing checkpoints) is unchanged
+        self.batch_norm1 = nn.BatchNorm2d(32)
+        self.batch_norm2 = nn.BatchNorm2d(64)
         self.cuda_destination = cuda_destination
 
     def forward(self, data, show_data=None):
@@ -42,12 +105,12 @@ class CNN(nn.Module):
         data = data.unsqueeze(1)
         data = self.conv1(data)
         data = data.squeeze(2)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         if show_data == 1:
             image_visualize(data, self.conv1.out_channels)
         data = self.conv2(data)
-        data = nn.BatchNorm2d(32).cuda(self.cuda_destination)(data)
-        data = nn.ReLU()(data)
+        data = self.batch_norm1(data)
+        data = torch.relu(data)
         if show_data == 2:
             image_visualize(data, self.conv2.out_channels)
         data = self.max_pool1(data)
@@ -55,12 +118,12 @@ class CNN(nn.Module):
             num_feature_maps, _, _ = data.squeeze(0).cpu().detach().numpy()
             image_visualize(data, num_feature_maps)
         data = self.conv3(data)
-        data = nn.BatchNorm2d(64).cuda(self.cuda_destination)(data)
-        data = nn.ReLU()(data)
+        data = self.batch_norm2(data)
+        data = torch.relu(data)
         if show_data == 4:
             image_visualize(data, self.conv3.out_channels)
         data = self.conv4(data)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         if show_data == 5:
             image_visualize(data, self.conv4.out_channels)
         data = self.max_pool2(data)
@@ -68,18 +131,24 @@ class CNN(nn.Module):
             num_feature_maps, _, _ = data.squeeze(0).cpu().detach().numpy()
             image_visualize(data, num_feature_maps)
         data = self.conv5(data)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         if show_data == 7:
             image_visualize(data, self.conv5.out_channels)
-        data = data.view(-1, 4 * 4 * 64)
+        data = data.reshape(-1, 4 * 4 * 64)
         data = self.dense1(data)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         data = self.dense2(data)
-        data = nn.Sigmoid()(data)
+        data = torch.sigmoid(data)
         return data
 
 
-class CNN2(nn.Module):
+class CNN2(BatchNormCompatible):
+
+    # The modules of each layer (see forward_layers and data_helpers.change_requires_grad), and the convolutions
+    # followed by batch norms
+    layers = [["conv1"], ["conv2", "batch_norm1"], ["max_pool1"], ["conv3", "batch_norm2"], ["conv4"], ["max_pool2"],
+              ["conv5"], ["gap"], ["dense"]]
+    conv_batch_norms = [("conv2", "batch_norm1"), ("conv3", "batch_norm2")]
 
     def __init__(self, cuda_destination):
         super(CNN2, self).__init__()
@@ -92,58 +161,81 @@ class CNN2(nn.Module):
         self.conv5 = nn.Conv2d(in_channels=64, out_channels=64, kernel_size=(2, 2), stride=1)
         self.gap = nn.AvgPool2d(kernel_size=(4, 4))
         self.dense = nn.Linear(in_features=64, out_features=2)
+        # Registered last so the order of the other parameters (and of existing checkpoints) is unchanged
+        self.batch_norm1 = nn.BatchNorm2d(32)
+        self.batch_norm2 = nn.BatchNorm2d(64)
         self.cuda_destination = cuda_destination
 
     def forward(self, data, want_activation_maps=False):
-        data = data.unsqueeze(1)
-        data = self.conv1(data)
-        data = data.squeeze(2)
-        data = nn.ReLU()(data)
-        data = self.conv2(data)
-        data = nn.BatchNorm2d(32).cuda(self.cuda_destination)(data)
-        data = nn.ReLU()(data)
-        data = self.max_pool1(data)
-        data = self.conv3(data)
-        data = nn.BatchNorm2d(64).cuda(self.cuda_destination)(data)
-        data = nn.ReLU()(data)
-        data = self.conv4(data)
-        data = nn.ReLU()(data)
-        data = self.max_pool2(data)
-        activation_maps = self.conv5(data)
-        activation_maps = nn.ReLU()(activation_maps)
-        data = self.gap(activation_maps)
-        data = data.view(-1, 64)  # Vector representation
-        data = self.dense(data)
-        data = nn.Softmax(1)(data)
+        activation_maps = self.forward_layers(data, 0, 7)
+        data = self.forward_layers(activation_maps, 7)
         if want_activation_maps:
             return data, activation_maps
         return data
 
-    def class_activation_mapping(self, image):
-        image = image.unsqueeze(0)
-        parameters = list(self.named_parameters())[-4:]
-        bias_vector = parameters[-1][1][:]
-        weights = parameters[-2][1][:]
-
-        outputs, activation_maps = self.forward(image, want_activation_maps=True)
-        outputs = [float(output) for output in outputs[0]]
-
-        activation_maps = activation_maps.squeeze(0).view(64, 4 * 4)
-        class_activations = weights.mm(activation_maps).view(2, 4, 4)
-        for idx in range(len(class_activations)):
-            class_activations[idx] = class_activations[idx] + bias_vector[idx]
+    def forward_layers(self, data, start=0, end=None):
+        """
+        Runs part of the network. Layers are counted as in self.layers (conv1, conv2, max_pool1, conv3, conv4,
+        max_pool2, conv5, gap, dense), and each includes the batch norm and activation that follow it
+        :param data: The input of layer start, a batch of crops when start is 0
+        :param start: The first layer to run
+        :param end: One past the last layer to run, None runs to the output
+        :return: The output of layer end - 1. Every intermediate output is [batch, channels, height, width], so the
+                 output of a frozen prefix can be cached and fed back in with start set to the prefix length
+        """
+        if end is None:
+            end = len(self.layers)
+        for layer in range(start, end):
+            if layer == 0:
+                data = data.unsqueeze(1)
+                data = self.conv1(data)
+                data = data.squeeze(2)
+                data = torch.relu(data)
+            elif layer == 1:
+                data = self.conv2(data)
+                data = self.batch_norm1(data)
+                data = torch.relu(data)
+            elif layer == 2:
+                data = self.max_pool1(data)
+            elif layer == 3:
+                data = self.conv3(data)
+                data = self.batch_norm2(data)
+                data = torch.relu(data)
+            elif layer == 4:
+                data = self.conv4(data)
+                data = torch.relu(data)
+            elif layer == 5:
+                data = self.max_pool2(data)
+            elif layer == 6:
+                data = self.conv5(data)
+                data = torch.relu(data)
+            elif layer == 7:
+                data = self.gap(data)
+            elif layer == 8:
+                data = data.reshape(-1, 64)  # Vector representation
+                data = self.dense(data)
+                data = torch.softmax(data, 1)
+        return data
 
-        class_activations = class_activations.unsqueeze(0).unsqueeze(2).squeeze(0)
+    def batch_class_activation_mapping(self, images, size=(32, 32)):
+        """
+        Class activation maps of a batch of crops, from a single forward pass
+        :param images: A [batch, 3, 32, 32] tensor of crops
+        :param size: The height and width the maps are upsampled to
+        :return: The class probabilities [batch, 2] and the maps [batch, 2, height, width], in class order
+                 (non-cancer, cancer). The map of the predicted class is heatmaps[range(batch), probabilities.argmax(1)]
+        """
+        probabilities, activation_maps = self.forward(images, want_activation_maps=True)
+        return probabilities, class_activation_maps(self.dense, activation_maps, size)
 
-        class_activations = nn.Upsample(size=(32, 32), mode="bilinear")(class_activations)
-        if outputs[0] < outputs[1]:
-            class_activations = torch.cat((class_activations[1], class_activations[0]), 0)
-            outputs = [("cancer", outputs[1]), ("non-cancer", outputs[0])]
-        else:
-            outputs = [("non-cancer", outputs[0]), ("cancer", outputs[1])]
+    def class_activation_mapping(self, image):
+        probabilities, heatmaps = self.batch_class_activation_mapping(image.unsqueeze(0))
+        outputs = [float(output) for output in probabilities[0]]
+        order = [1, 0] if outputs[0] < outputs[1] else [0, 1]
+        names = ["non-cancer", "cancer"]
 
-        # Returns a 2 x 32 x 32 tensor and what each class activation map represents
-        return class_activations.squeeze(0).squeeze(1), outputs
+        # Returns a 2 x 32 x 32 tensor (the predicted class first) and what each class activation map represents
+        return heatmaps[0, order], [(names[idx], outputs[idx]) for idx in order]
 
     @staticmethod
     def visualize(image, heatmap, code=0, alpha=0.4):
@@ -158,6 +250,61 @@ class CNN2(nn.Module):
         plt.show()
 
 
+class CNN2Head(nn.Module):
+    """
+    The layers of a CNN2 that come after a frozen prefix, for training on features cached from the prefix (see
+    data_helpers.cache_features). The parameters are shared with the wrapped network
+    """
+
+    def __init__(self, model, first_layer):
+        """
+        :param model: The CNN2
+        :param first_layer: The number of frozen layers, the head starts at this layer (see CNN2.forward_layers)
+        """
+        super(CNN2Head, self).__init__()
+        self.model = model
+        self.first_layer = first_layer
+
+    def forward(self, data):
+        return self.model.forward_layers(data, self.first_layer)
+
+
+class FullyConvolutionalCNN2(nn.Module):
+    """
+    A CNN2 rewritten as a fully convolutional network, which scores every 3 x 32 x 32 window of a volume in one pass:
+    conv1 slides over the slices as well, the global average pooling becomes a 4 x 4 average pooling with stride 1 and
+    the dense layer a 1 x 1 convolution. The two max poolings give the output a stride of 4, output (i, j) of slice k
+    is exactly the CNN2's output on the window whose first slice is k and whose top left corner is (4 * i, 4 * j). The
+    parameters are shared with the wrapped network, whose batch norms need running statistics
+    """
+
+    stride = 4
+
+    def __init__(self, model):
+        """
+        :param model: The CNN2
+        """
+        super(FullyConvolutionalCNN2, self).__init__()
+        self.model = model
+
+    def forward(self, volumes):
+        """
+        :param volumes: A [batch, depth, height, width] tensor of normalized volumes
+        :return: The [batch, depth - 2, 2, rows, columns] class probabilities of the windows
+        """
+        batch, depth, height, width = volumes.shape
+        data = self.model.conv1(volumes.unsqueeze(1))
+        data = torch.relu(data)
+        # Every window of 3 slices becomes an item of the batch of the 2D layers
+        data = data.transpose(1, 2).reshape(batch * (depth - 2), -1, height - 2, width - 2)
+        data = self.model.forward_layers(data, 1, 7)
+        data = nn.functional.avg_pool2d(data, kernel_size=self.model.gap.kernel_size, stride=1)
+        dense = self.model.dense
+        data = nn.functional.conv2d(data, dense.weight.view(*dense.weight.shape, 1, 1), dense.bias)
+        data = torch.softmax(data, 1)
+        return data.view(batch, depth - 2, *data.shape[1:])
+
+
 class MNIST_CNN(nn.Module):
 
     def __init__(self, cuda_destination):
@@ -175,44 +322,35 @@ class MNIST_CNN(nn.Module):
         data = data.unsqueeze(1)
         data = self.conv1(data)
         data = data.squeeze(2)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         data = self.conv3(data)
-        data = nn.ReLU()(data)
+        data = torch.relu(data)
         activation_maps = self.conv4(data)
-        activation_maps = nn.ReLU()(activation_maps)
+        activation_maps = torch.relu(activation_maps)
         data = self.gap(activation_maps)
-        data = data.view(-1, 64)  # Vector representation
+        data = data.reshape(-1, 64)  # Vector representation
         data = self.dense(data)
-        data = nn.LogSoftmax(1)(data)
+        data = torch.log_softmax(data, 1)
         if want_activation_maps:
             return data, activation_maps
 
         return data
 
+    def batch_class_activation_mapping(self, images, size=(28, 28)):
+        """
+        Class activation maps of a batch of digits, from a single forward pass
+        :param images: A [batch, 28, 28] tensor of images
+        :param size: The height and width the maps are upsampled to
+        :return: The log probabilities [batch, 10] and the maps [batch, 10, height, width] of every class
+        """
+        log_probabilities, activation_maps = self.forward(images, want_activation_maps=True)
+        return log_probabilities, class_activation_maps(self.dense, activation_maps, size)
+
     def class_activation_mapping(self, image):
-        parameters = list(self.named_parameters())[-4:]
-        bias_vector = parameters[-1][1][:]
-        weights = parameters[-2][1][:]
-
-        outputs, activation_maps = self.forward(image, want_activation_maps=True)
-        outputs = [float(output) for output in outputs[0]]
-
-        activation_maps = activation_maps.squeeze(0).view(64, 4 * 4)
-        class_activations = weights.mm(activation_maps).view(10, 4, 4)
-        for idx in range(len(class_activations)):
-            class_activations[idx] = class_activations[idx] + bias_vector[idx]
-
-        class_activations = class_activations.unsqueeze(0).unsqueeze(2).squeeze(0)
-
-        # plt.imshow(class_activations)
-        # plt.show()
-        probs = [np.power(np.e, output) for output in outputs]
-        argmax = torch.argmax(torch.tensor(probs))
-        # print(probs)
-        class_activations = nn.Upsample(size=(28, 28), mode="bilinear")(class_activations)
-        class_activations = class_activations[torch.argmax(torch.tensor(probs))]
-        # Returns a 2 x 32 x 32 tensor and what each class activation map represents
-        return class_activations.squeeze(0), outputs
+        log_probabilities, heatmaps = self.batch_class_activation_mapping(image)
+        outputs = [float(output) for output in log_probabilities[0]]
+        # Returns the 28 x 28 map of the predicted class and the log probabilities
+        return heatmaps[0, log_probabilities[0].argmax()], outputs
 
     @staticmethod
     def visualize(image, heatmap, alpha=0.4):
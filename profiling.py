@@ -0,0 +1,225 @@
+from contextlib import nullcontext
+import json
+import os
+import time
+import pandas as pd
+import torch
+
+
+class _Phase:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.synchronize()
+        elapsed = time.perf_counter() - self.start
+        self.timer.seconds[self.name] = self.timer.seconds.get(self.name, 0.0) + elapsed
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall time spent in each phase of an epoch (ex. "train/data", "train/forward") and the number of
+    samples processed, and appends one JSON line per epoch to a log. When disabled, phase returns a shared no-op context
+    manager, so leaving the instrumentation in the loop costs nothing measurable
+    """
+
+    _disabled_phase = nullcontext()
+
+    def __init__(self, device, log_path=None, enabled=True):
+        """
+        :param device: The device the model runs on. On a GPU every phase boundary synchronizes, so that asynchronous
+                       kernels are charged to the phase that launched them
+        :param log_path: The JSON lines file the epoch records are appended to, if None they are only kept in
+                         self.records
+        :param enabled: Whether anything is timed
+        """
+        self.enabled = enabled
+        self.log_path = log_path
+        self.cuda = torch.device(device).type == "cuda"
+        self.records = []
+        self.seconds = dict()
+        self.samples = dict()
+        self.epoch_start = time.perf_counter()
+
+    def synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        """
+        :param name: The phase, by convention "split/stage" (ex. "validation/metrics")
+        :return: A context manager that adds the time spent inside it to the phase
+        """
+        if not self.enabled:
+            return self._disabled_phase
+        return _Phase(self, name)
+
+    def add_samples(self, split, num_samples):
+        """
+        :param split: "train" or "validation"
+        :param num_samples: How many samples the last batch had
+        :return: None
+        """
+        if self.enabled:
+            self.samples[split] = self.samples.get(split, 0) + num_samples
+
+    def end_epoch(self, epoch):
+        """
+        Writes the epoch's record and starts timing the next one. The record holds the wall time of the epoch, the
+        seconds of every phase, the time not covered by any phase ("other"), and the samples and samples per second
+        of each split (the split's samples over the summed time of its phases)
+        :param epoch: The epoch that just ended
+        :return: The record, or None if the timer is disabled
+        """
+        if not self.enabled:
+            return None
+        self.synchronize()
+        wall = time.perf_counter() - self.epoch_start
+        record = {"epoch": epoch, "wall": wall, "phases": self.seconds, "other": wall - sum(self.seconds.values()),
+                  "samples": self.samples, "samples_per_second": dict()}
+        for split, num_samples in self.samples.items():
+            split_seconds = sum(seconds for name, seconds in self.seconds.items() if name.startswith(split + "/"))
+            record["samples_per_second"][split] = num_samples / split_seconds if split_seconds > 0 else None
+        self.records.append(record)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        self.seconds = dict()
+        self.samples = dict()
+        self.epoch_start = time.perf_counter()
+        return record
+
+
+class EpochClock:
+    """
+    Only the wall time and the samples of each epoch, what a run records when the per-phase timings of PhaseTimer are
+    off. On a GPU it synchronizes once per epoch, so unlike PhaseTimer it does not slow training down
+    """
+
+    def __init__(self, device, enabled=True):
+        """
+        :param device: The device the model runs on
+        :param enabled: Whether anything is timed
+        """
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == "cuda"
+        self.samples = dict()
+        self.epoch_start = None
+
+    def start(self):
+        """
+        Starts timing the first epoch, every later one starts when the previous one ends
+        :return: None
+        """
+        if self.enabled:
+            if self.cuda:
+                torch.cuda.synchronize()
+            self.epoch_start = time.perf_counter()
+
+    def add_samples(self, split, num_samples):
+        if self.enabled:
+            self.samples[split] = self.samples.get(split, 0) + num_samples
+
+    def end_epoch(self, epoch):
+        """
+        :param epoch: The epoch that just ended
+        :return: A record in the format of PhaseTimer.end_epoch, without phases, or None if the clock is disabled
+        """
+        if not self.enabled:
+            return None
+        if self.cuda:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        record = {"epoch": epoch, "wall": end - self.epoch_start, "phases": dict(), "samples": self.samples,
+                  "samples_per_second": dict()}
+        self.samples = dict()
+        self.epoch_start = end
+        return record
+
+
+def summarize_timings(log_path):
+    """
+    Reads a log written by PhaseTimer and shows where the time goes
+    :param log_path: The JSON lines file
+    :return: A dataframe with one row per phase (and "other"): the mean seconds per epoch and the share of the wall time
+    """
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    phases = pd.DataFrame([dict(record["phases"], other=record["other"]) for record in records]).fillna(0)
+    wall = sum(record["wall"] for record in records)
+    summary = pd.DataFrame({"seconds_per_epoch": phases.mean(), "fraction": phases.sum() / wall})
+    return summary.sort_values("seconds_per_epoch", ascending=False)
+
+
+class StepProfiler:
+    """
+    Runs torch.profiler over a window of steps (batches): the first wait steps are skipped, the next warmup steps are
+    profiled and thrown away, and the following active steps are recorded. When the window closes, a Chrome trace
+    (open it in chrome://tracing or https://ui.perfetto.dev) and a table of the top_n operators by self time are written
+    to trace_dir. When disabled, every method is a no-op
+    """
+
+    def __init__(self, trace_dir, name, device, window=(1, 1, 5), top_n=20, enabled=True):
+        """
+        :param trace_dir: The directory the traces and tables are written to
+        :param name: The prefix of the files, ex. "train" or "test"
+        :param device: The device the model runs on, CUDA kernels are profiled as well on a GPU
+        :param window: The (wait, warmup, active) numbers of steps
+        :param top_n: How many operators the table lists
+        :param enabled: Whether anything is profiled
+        """
+        self.enabled = enabled
+        self.profiler = None
+        if not enabled:
+            return
+        os.makedirs(trace_dir, exist_ok=True)
+        self.trace_dir = trace_dir
+        self.name = name
+        self.top_n = top_n
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        self.sort_by = "self_cpu_time_total"
+        if torch.device(device).type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.sort_by = "self_cuda_time_total"
+        wait, warmup, active = window
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                               schedule=torch.profiler.schedule(wait=wait, warmup=warmup,
+                                                                                active=active, repeat=1),
+                                               on_trace_ready=self._export)
+
+    def _export(self, profiler):
+        path = "{}/{}_step{}".format(self.trace_dir, self.name, profiler.step_num)
+        profiler.export_chrome_trace("{}.json".format(path))
+        table = profiler.key_averages().table(sort_by=self.sort_by, row_limit=self.top_n)
+        with open("{}_top{}.txt".format(path, self.top_n), "w") as f:
+            f.write(table)
+        print("Profile of {} written to {}.json".format(self.name, path))
+        print(table)
+
+    def start(self):
+        if self.profiler:
+            self.profiler.start()
+
+    def step(self):
+        """
+        Marks the end of a step
+        :return: None
+        """
+        if self.profiler:
+            self.profiler.step()
+
+    def stop(self):
+        """
+        Stops profiling, exporting the window if it was still open
+        :return: None
+        """
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler = None
@@ -0,0 +1,150 @@
+import copy
+import io
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+from torch.utils.data import DataLoader, Subset
+from metrics import BinaryMetrics
+from engine import fuse_for_inference, estimate_batch_norm_statistics, configure_threads
+from model_registry import load_model
+
+
+class QuantizedCNN2(nn.Module):
+    """
+    A CNN2 prepared for static int8 quantization: the crops are quantized on the way in, the convolution stack runs in
+    int8 (with the batch norms folded into the convolutions), and the pooled features are dequantized before the dense
+    layer and softmax, which stay in float
+    """
+
+    def __init__(self, model):
+        """
+        :param model: The CNN2, its batch norms need running statistics
+        """
+        super(QuantizedCNN2, self).__init__()
+        self.quant = QuantStub()
+        self.model = fuse_for_inference(model)
+        self.dequant = DeQuantStub()
+
+    def forward(self, data):
+        data = self.quant(data)
+        data = self.model.forward_layers(data, 0, 8)
+        data = self.dequant(data)
+        return self.model.forward_layers(data, 8)
+
+
+def quantize_static_cnn2(model, calibration_loader, backend="x86"):
+    """
+    Post-training static int8 quantization of a CNN2. Batch norms without running statistics (old checkpoints) are
+    given some from the calibration data first
+    :param model: The float CNN2, on the CPU. It is not modified
+    :param calibration_loader: A loader over a representative sample of crops, used to pick the activation ranges
+    :param backend: The quantized engine, "x86" (or "fbgemm") for servers, "qnnpack" for ARM
+    :return: The int8 model
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu()
+    if not model.batch_norm1.track_running_stats:
+        estimate_batch_norm_statistics(model, calibration_loader, "cpu")
+    quantized = QuantizedCNN2(model).eval()
+    quantized.qconfig = get_default_qconfig(backend)
+    quantized.model.dense.qconfig = None
+    prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for batch in calibration_loader:
+            quantized(batch["image"])
+    return convert(quantized, inplace=True)
+
+
+def quantize_dynamic_cnn2(model):
+    """
+    Dynamic int8 quantization of the dense layer of a CNN2 (the weights are stored in int8, the activations are
+    quantized on the fly). The convolutions, where the time goes, stay in float
+    :param model: The float CNN2, on the CPU. It is not modified
+    :return: The quantized model
+    """
+    return quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model):
+    """
+    :return: The size of the model's serialized state dict in megabytes
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def evaluate(model, data_loader, num_timing_runs=10):
+    """
+    :param model: A float or quantized CNN2 on the CPU
+    :param data_loader: A loader over labelled crops
+    :param num_timing_runs: The number of times the first batch is rerun to time the model
+    :return: A dictionary with the accuracy, AUC and F1 on the data, the milliseconds per batch and samples per second
+             (on the first batch) and the model's size
+    """
+    model.eval()
+    metrics = BinaryMetrics("cpu")
+    first_batch = None
+    with torch.inference_mode():
+        for batch in data_loader:
+            images = batch["image"].cpu()
+            if first_batch is None:
+                first_batch = images
+            metrics.update(model(images), batch["cancer"].cpu())
+        start = time.perf_counter()
+        for _ in range(num_timing_runs):
+            model(first_batch)
+        seconds = (time.perf_counter() - start) / num_timing_runs
+    stats = metrics.compute()
+    confusion_matrix = stats["confusion_matrix"]
+    return {"accuracy": np.trace(confusion_matrix) / confusion_matrix.sum(), "auc": stats["auc"], "f1": stats["f1"],
+            "ms_per_batch": 1000 * seconds, "samples_per_second": len(first_batch) / seconds,
+            "size_mb": model_size_mb(model)}
+
+
+def compare_models(models, data_loader, baseline="float"):
+    """
+    :param models: A dictionary from a name to a model
+    :param data_loader: The labelled crops they are evaluated on
+    :param baseline: The name of the model the others are compared to
+    :return: A dataframe with one row per model (see evaluate), the accuracy and AUC deltas against the baseline and
+             the speedup and size reduction relative to it
+    """
+    table = pd.DataFrame({name: evaluate(model, data_loader) for name, model in models.items()}).T
+    table["accuracy_delta"] = table["accuracy"] - table.loc[baseline, "accuracy"]
+    table["auc_delta"] = table["auc"] - table.loc[baseline, "auc"]
+    table["speedup"] = table.loc[baseline, "ms_per_batch"] / table["ms_per_batch"]
+    table["size_reduction"] = table.loc[baseline, "size_mb"] / table["size_mb"]
+    return table
+
+
+if __name__ == "__main__":
+    from data_helpers import ProstateImages, load_folds
+
+    modality = "bval"
+    model_number = 46
+    fold = 0
+    num_calibration_crops = 1000
+    batch_size = 100
+    num_threads = 1  # Per-core numbers, the scoring runs use one process per core
+    configure_threads(num_threads)
+
+    model = load_model("CNN2", model_number, modality)
+
+    # Calibrate on crops of the fold's training set, evaluate on its validation set
+    train_indices, fold_indices = load_folds("/home/andrewg/PycharmProjects/assignments/folds2.npz")
+    p_images = ProstateImages(modality=modality, train=True, device="cpu", normalize_strategy=1)
+    calibration_indices = np.random.default_rng(0).permutation(train_indices[fold])[:num_calibration_crops]
+    calibration_loader = DataLoader(Subset(p_images, calibration_indices), batch_size=batch_size)
+    validation_loader = DataLoader(Subset(p_images, fold_indices[fold]), batch_size=batch_size)
+
+    calibrated = copy.deepcopy(model)
+    estimate_batch_norm_statistics(calibrated, calibration_loader, "cpu")
+    models = {"float": model,
+              "float (running statistics, folded)": fuse_for_inference(calibrated),
+              "dynamic int8 (dense)": quantize_dynamic_cnn2(model),
+              "static int8": quantize_static_cnn2(model, calibration_loader)}
+    print(compare_models(models, validation_loader).to_string())
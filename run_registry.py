@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import time
+import pandas as pd
+import torch
+
+DEFAULT_REGISTRY = "/home/andrewg/PycharmProjects/assignments/predictions/runs.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    status TEXT,
+    started TEXT,
+    finished TEXT,
+    config TEXT,
+    hardware TEXT
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id INTEGER,
+    fold INTEGER,
+    epoch INTEGER,
+    train_loss REAL,
+    train_auc REAL,
+    train_f1 REAL,
+    val_loss REAL,
+    val_auc REAL,
+    val_f1 REAL,
+    wall REAL,
+    samples INTEGER,
+    train_samples_per_second REAL,
+    val_samples_per_second REAL,
+    phases TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER,
+    fold INTEGER,
+    auc_train REAL,
+    f1_train REAL,
+    auc_eval REAL,
+    f1_eval REAL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER,
+    kind TEXT,
+    path TEXT
+);
+"""
+
+
+def hardware_info():
+    """
+    :return: A dictionary describing the machine and the torch build a run uses
+    """
+    info = {"host": platform.node(), "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "torch": torch.__version__, "torch_threads": torch.get_num_threads(),
+            "cuda": torch.cuda.is_available()}
+    if info["cuda"]:
+        info["gpus"] = [torch.cuda.get_device_name(idx) for idx in range(torch.cuda.device_count())]
+    return info
+
+
+def _now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class RunRegistry:
+    """
+    A sqlite database of training runs: each run's config and hardware, its per-epoch metrics, wall time and samples
+    (and phase timings, when they were recorded), the final scores of every fold and the paths of the files it wrote. A
+    connection is opened for every write, so the registry can be shared with forked fold workers
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY):
+        """
+        :param path: The sqlite file, created (with its tables) if it does not exist
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executescript(SCHEMA)
+                # Registries created before the samples were recorded
+                columns = [row[1] for row in connection.execute("PRAGMA table_info(epochs)")]
+                if "samples" not in columns:
+                    connection.execute("ALTER TABLE epochs ADD COLUMN samples INTEGER")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def _execute(self, statement, parameters=()):
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(statement, parameters)
+            return cursor.lastrowid
+        finally:
+            connection.close()
+
+    def _query(self, statement, parameters=()):
+        connection = self._connect()
+        try:
+            return pd.read_sql_query(statement, connection, params=parameters)
+        finally:
+            connection.close()
+
+    def start_run(self, name, config):
+        """
+        :param name: A short description, ex. "A3 adc CNN"
+        :param config: A JSON serializable dictionary of the run's hyperparameters
+        :return: The id of the new run, also used to number the files it writes
+        """
+        return self._execute("INSERT INTO runs (name, status, started, config, hardware) VALUES (?, ?, ?, ?, ?)",
+                             (name, "running", _now(), json.dumps(config, default=str), json.dumps(hardware_info())))
+
+    def finish_run(self, run_id, status="finished"):
+        self._execute("UPDATE runs SET status = ?, finished = ? WHERE run_id = ?", (status, _now(), run_id))
+
+    def log_epoch(self, run_id, fold, epoch, train_stats, val_stats=None, timing=None):
+        """
+        :param run_id: The run
+        :param fold: The fold being trained, or None
+        :param epoch: The epoch that just ended (counting from 1)
+        :param train_stats: The training metrics of the epoch (see metrics.BinaryMetrics.compute)
+        :param val_stats: The validation metrics, if the validation set was evaluated this epoch
+        :param timing: The epoch's record from profiling.PhaseTimer or profiling.EpochClock, if any. Only the former has
+                       phase timings and per-split throughputs
+        :return: None
+        """
+        val_stats = val_stats or dict()
+        timing = timing or {"phases": dict(), "samples": dict(), "samples_per_second": dict()}
+        samples = sum(timing["samples"].values()) if timing["samples"] else None
+        self._execute("INSERT INTO epochs (run_id, fold, epoch, train_loss, train_auc, train_f1, val_loss, val_auc, "
+                      "val_f1, wall, samples, train_samples_per_second, val_samples_per_second, phases) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (run_id, fold, epoch, train_stats["loss"], train_stats["auc"], train_stats["f1"],
+                       val_stats.get("loss"), val_stats.get("auc"), val_stats.get("f1"), timing.get("wall"), samples,
+                       timing["samples_per_second"].get("train"), timing["samples_per_second"].get("validation"),
+                       json.dumps(timing["phases"])))
+
+    def log_result(self, run_id, fold, scores):
+        """
+        :param scores: The fold's (auc train, f1 train, auc validation, f1 validation)
+        """
+        self._execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                      (run_id, fold) + tuple(None if score is None else float(score) for score in scores))
+
+    def log_artifact(self, run_id, kind, path):
+        """
+        :param kind: What the file is, ex. "model" or "predictions"
+        """
+        self._execute("INSERT INTO artifacts VALUES (?, ?, ?)", (run_id, kind, path))
+
+    def runs(self):
+        """
+        :return: One row per run with its mean fold scores, its throughput (the samples of every epoch over their wall
+                 time) and, if its phases were timed, its mean training throughput
+        """
+        return self._query("""
+            SELECT runs.run_id, name, status, started,
+                   (SELECT AVG(auc_eval) FROM results WHERE results.run_id = runs.run_id) AS auc_eval,
+                   (SELECT AVG(f1_eval) FROM results WHERE results.run_id = runs.run_id) AS f1_eval,
+                   (SELECT SUM(samples) / SUM(wall) FROM epochs WHERE epochs.run_id = runs.run_id)
+                       AS samples_per_second,
+                   (SELECT AVG(train_samples_per_second) FROM epochs WHERE epochs.run_id = runs.run_id)
+                       AS train_samples_per_second
+            FROM runs ORDER BY runs.run_id""")
+
+    def epochs(self, run_id):
+        return self._query("SELECT * FROM epochs WHERE run_id = ? ORDER BY fold, epoch", (run_id,))
+
+    def results(self, run_id):
+        return self._query("SELECT * FROM results WHERE run_id = ? ORDER BY fold", (run_id,))
+
+    def artifacts(self, run_id):
+        return self._query("SELECT kind, path FROM artifacts WHERE run_id = ?", (run_id,))
+
+    def config(self, run_id):
+        """
+        :return: The config and hardware dictionaries of a run
+        """
+        row = self._query("SELECT config, hardware FROM runs WHERE run_id = ?", (run_id,)).iloc[0]
+        return json.loads(row["config"]), json.loads(row["hardware"])
+
+    def phase_seconds(self, run_id):
+        """
+        :return: The mean seconds per epoch of every timed phase of a run, empty if its phases were not timed
+        """
+        phases = pd.DataFrame([json.loads(phases) for phases in self.epochs(run_id)["phases"]])
+        return phases.mean()
+
+    def compare(self, run_ids):
+        """
+        Lines up runs side by side: the hyperparameters that differ, the mean fold scores, the throughput and the mean
+        seconds per epoch of each phase
+        :param run_ids: The runs to compare
+        :return: A dataframe with one column per run
+        """
+        columns = dict()
+        configs = {run_id: self.config(run_id)[0] for run_id in run_ids}
+        differing = sorted(key for key in set().union(*configs.values())
+                           if len(set(json.dumps(config.get(key)) for config in configs.values())) > 1)
+        for run_id in run_ids:
+            epochs = self.epochs(run_id)
+            column = {key: configs[run_id].get(key) for key in differing}
+            column.update(self.results(run_id)[["auc_train", "f1_train", "auc_eval", "f1_eval"]].mean().to_dict())
+            column["samples_per_second"] = epochs["samples"].sum() / epochs["wall"].sum()
+            column["train_samples_per_second"] = epochs["train_samples_per_second"].mean()
+            column["val_samples_per_second"] = epochs["val_samples_per_second"].mean()
+            column["seconds_per_epoch"] = epochs["wall"].mean()
+            column.update({"phase " + phase: seconds for phase, seconds in self.phase_seconds(run_id).items()})
+            columns[run_id] = column
+        return pd.DataFrame(columns)
+
+
+class RunLog:
+    """
+    Where train_model reports each epoch: a run of a registry and the fold being trained
+    """
+
+    def __init__(self, registry, run_id, fold=None):
+        self.registry = registry
+        self.run_id = run_id
+        self.fold = fold
+
+    def log_epoch(self, epoch, train_stats, val_stats=None, timing=None):
+        self.registry.log_epoch(self.run_id, self.fold, epoch, train_stats, val_stats, timing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the run registry")
+    parser.add_argument("--db", default=DEFAULT_REGISTRY, help="The registry file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Every run with its mean scores and throughput")
+    show = commands.add_parser("show", help="The config, hardware, fold scores, epochs and files of a run")
+    show.add_argument("run_id", type=int)
+    compare = commands.add_parser("compare", help="Runs side by side, including per-phase timings")
+    compare.add_argument("run_ids", type=int, nargs="+")
+    args = parser.parse_args()
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_columns", 50)
+    registry = RunRegistry(args.db)
+    if args.command == "list":
+        print(registry.runs().to_string(index=False))
+    elif args.command == "show":
+        config, hardware = registry.config(args.run_id)
+        print("Config: {}".format(json.dumps(config, indent=2)))
+        print("Hardware: {}".format(json.dumps(hardware, indent=2)))
+        print(registry.results(args.run_id).to_string(index=False))
+        print(registry.epochs(args.run_id).drop(columns=["phases"]).to_string(index=False))
+        print(registry.artifacts(args.run_id).to_string(index=False))
+    else:
+        print(registry.compare(args.run_ids).to_string())
@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+
+
+class TorchScriptScorer:
+    """
+    Scores crops with a TorchScript artifact written by export.export_torchscript. Only torch is needed, not models.py
+    """
+
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: The .pt artifact
+        :param num_threads: The torch thread budget, None keeps the default
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = torch.jit.load(path, map_location="cpu")
+
+    def __call__(self, crops):
+        """
+        :param crops: A float32 array (or tensor) of shape [batch, 3, 32, 32]
+        :return: The model's outputs as a NumPy array ([batch, 2] for CNN2, [batch, 1] for CNN)
+        """
+        with torch.inference_mode():
+            return self.model(torch.as_tensor(crops, dtype=torch.float32)).numpy()
+
+
+class OnnxScorer:
+    """
+    Scores crops with an ONNX artifact written by export.export_onnx, on ONNX Runtime's CPU provider
+    """
+
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: The .onnx artifact
+        :param num_threads: The intra-op thread budget, None lets ONNX Runtime decide
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, crops):
+        """
+        :param crops: A float32 array (or tensor) of shape [batch, 3, 32, 32]
+        :return: The model's outputs as a NumPy array
+        """
+        crops = np.ascontiguousarray(np.asarray(crops, dtype=np.float32))
+        return self.session.run(None, {self.input_name: crops})[0]
+
+
+def load_scorer(path, num_threads=None):
+    """
+    :param path: A .onnx or TorchScript .pt artifact
+    :param num_threads: The CPU thread budget
+    :return: A callable from a [batch, 3, 32, 32] array of crops to the model's outputs
+    """
+    if path.endswith(".onnx"):
+        return OnnxScorer(path, num_threads=num_threads)
+    return TorchScriptScorer(path, num_threads=num_threads)
@@ -0,0 +1,106 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+from engine import configure_threads
+
+
+def grid(search_space):
+    """
+    Expands a search space into every combination of its values
+    :param search_space: A dictionary mapping each hyperparameter name to a list of values
+    :return: A list of dictionaries, one per configuration
+    """
+    names = list(search_space)
+    return [dict(zip(names, values)) for values in itertools.product(*[search_space[name] for name in names])]
+
+
+def rung_budgets(min_epochs, max_epochs, reduction_factor=3):
+    """
+    :return: The epoch budgets of successive halving, min_epochs * reduction_factor^i, capped by max_epochs
+    """
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= reduction_factor
+    budgets.append(max_epochs)
+    return budgets
+
+
+_sweep_job = None  # The trial function and configurations shared with forked sweep workers
+
+
+def _sweep_worker_init(num_threads):
+    configure_threads(num_threads)
+
+
+def _run_sweep_job(trial_and_epochs):
+    trial_fn, configs = _sweep_job
+    trial_id, epochs = trial_and_epochs
+    return trial_fn(trial_id, configs[trial_id], epochs)
+
+
+def successive_halving(configs, trial_fn, min_epochs, max_epochs, reduction_factor=3, num_workers=1,
+                       threads_per_worker=None, device="cpu"):
+    """
+    Runs a hyperparameter sweep with successive halving. Every configuration is trained for min_epochs, the best
+    1 / reduction_factor of them go on to reduction_factor times as many epochs, and so on until max_epochs, so weak
+    trials are stopped early. The trials of a rung are run concurrently in forked worker processes, which inherit
+    anything the parent loaded beforehand (ex. pretrained weights and datasets)
+    :param configs: A list of hyperparameter dictionaries (see grid)
+    :param trial_fn: A function (trial_id, config, epochs) -> score which trains trial trial_id up to a total of epochs
+                     epochs, continuing from where its previous rung stopped (ex. through train_model's resume_path),
+                     and returns a score where higher is better
+    :param min_epochs: The budget of the first rung
+    :param max_epochs: The budget of the last rung
+    :param reduction_factor: How many trials are dropped for every one kept after each rung
+    :param num_workers: How many trials are trained at the same time. Only supported on the CPU, CUDA cannot be used
+                        in processes forked after it was initialized
+    :param threads_per_worker: The torch thread budget of each worker, defaults to splitting the cores evenly
+    :param device: The device the trials train on
+    :return: A dataframe with one row per trial and rung it reached (trial, rung, epochs, score and the
+             hyperparameters), sorted from the best to the worst trial
+    """
+    global _sweep_job
+    results = []
+    survivors = list(range(len(configs)))
+    budgets = rung_budgets(min_epochs, max_epochs, reduction_factor)
+
+    executor = None
+    if num_workers > 1:
+        if torch.device(device).type != "cpu":
+            raise ValueError("Parallel trials are only supported on the CPU, not {}".format(device))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // num_workers)
+        _sweep_job = (trial_fn, configs)
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"),
+                                       initializer=_sweep_worker_init, initargs=(threads_per_worker,))
+    try:
+        for rung, epochs in enumerate(budgets):
+            print("Rung {}: {} trials for {} epochs".format(rung, len(survivors), epochs))
+            jobs = [(trial_id, epochs) for trial_id in survivors]
+            if executor:
+                scores = list(executor.map(_run_sweep_job, jobs))
+            else:
+                scores = [trial_fn(trial_id, configs[trial_id], epochs) for trial_id, epochs in jobs]
+
+            for trial_id, score in zip(survivors, scores):
+                results.append(dict(trial=trial_id, rung=rung, epochs=epochs, score=score, **configs[trial_id]))
+
+            num_kept = max(1, len(survivors) // reduction_factor)
+            ranking = np.argsort(-np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=-np.inf), kind="stable")
+            survivors = [survivors[idx] for idx in ranking[:num_kept]]
+    finally:
+        if executor:
+            executor.shutdown()
+        _sweep_job = None
+
+    table = pd.DataFrame(results)
+    final_rows = table.groupby("trial")["rung"].transform("max") == table["rung"]
+    order = table[final_rows].sort_values(["rung", "score"], ascending=False)["trial"].tolist()
+    table["trial"] = pd.Categorical(table["trial"], categories=order, ordered=True)
+    return table.sort_values(["trial", "rung"]).reset_index(drop=True)